@@ -1,132 +1,296 @@
+import argparse
+import hashlib
 import json
-import matplotlib.pyplot as plt
-from collections import defaultdict
-import pandas as pd
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 
-def analyze_corpus(json_file_path, lang, distrib, decade):
-    labels_per_year = defaultdict(lambda: defaultdict(int))
-    labels_per_source = defaultdict(lambda: defaultdict(int))
-    all_labels = set()
-    with open(json_file_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            data = json.loads(line)
+# Annotated JSONL of a language and the directory its charts are written to, {lang} is the language code
+ANNOTATED_JSONL = 'articles_{lang}_corpus_annotated.jsonl'
+STATS_DIR = 'results/{lang}_stats'
 
-            # --- ID Parsing ---
-            parts = data['id'].split('-_')
-            date_part = parts[0]
-            year = date_part.split('-')[0]
-            if decade:
-                year = year[:-1] + '0s'
-            source_and_id = parts[1].split('_')
-            source = source_and_id[0]
+# Title, x label and y label of every chart, named <year|decade|source>_<count|distrib>
+CHARTS = {
+    'year_count': ('Number of Different Labels per Year', 'Year', 'Number of Labels'),
+    'decade_count': ('Number of Different Labels per Year', 'Year', 'Number of Labels'),
+    'source_count': ('Number of Different Labels per Source', 'Source', 'Number of Labels'),
+    'year_distrib': ('Distribution of Annotation Labels per Year', 'Year', 'Distribution of Labels (%)'),
+    'decade_distrib': ('Distribution of Annotation Labels per Year', 'Year', 'Distribution of Labels (%)'),
+    'source_distrib': ('Distribution of Annotation Labels per Source', 'Source', 'Distribution of Labels (%)'),
+}
+
+# Size of the head and tail of the read part of a JSONL that are hashed to detect a rewritten file
+FINGERPRINT_BYTES = 65536
+
+
+def pyplot():
+    """matplotlib.pyplot, imported on first use."""
+    import matplotlib
+    # Charts are only saved to files, so no display is needed (also in the worker processes)
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def normalize_label(label):
+    return label.strip().replace('Metaphors', 'Metaphore').replace('Metaphore', 'Metaphor')
+
+
+class LabelCounts:
+    """
+    Label counts of one annotated corpus as a year x source x label tensor of integers.
+    The year, source and label names belonging to the indices are kept in years, sources and labels.
+    """
+
+    def __init__(self, counts, years, sources, labels):
+        self.counts = counts
+        self.years = years
+        self.sources = sources
+        self.labels = labels
+
+    def per_year(self, decade=False):
+        import pandas as pd
+        df = pd.DataFrame(self.counts.sum(axis=1), index=self.years, columns=self.labels)
+        if decade:
+            df = df.groupby(lambda year: year[:-1] + '0s').sum()
+        return df.sort_index()
 
+    def per_source(self):
+        import pandas as pd
+        return pd.DataFrame(self.counts.sum(axis=0), index=self.sources, columns=self.labels)
+
+
+def count_labels(json_file_path, label_counts=None, offset=0):
+    """
+    Read an annotated JSONL once and count every label per year and source. Years, sources and
+    labels are integer coded while reading, and every distinct raw label is normalized only once.
+
+    With label_counts and offset, only the lines from byte offset on are read and added to the
+    given counts. Returns the counts and the offset up to which the file has been read; a last
+    line that is still being written is left for the next call.
+    """
+    if label_counts is None:
+        label_counts = LabelCounts(np.zeros((0, 0, 0), dtype=np.int64), [], [], [])
+    codes = {kind: {name: k for k, name in enumerate(names)} for kind, names in
+             [('year', label_counts.years), ('source', label_counts.sources), ('label', label_counts.labels)]}
+    label_codes = {}
+    year_codes, source_codes, label_indices = [], [], []
+
+    def code(kind, name):
+        return codes[kind].setdefault(name, len(codes[kind]))
+
+    with open(json_file_path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            if not line.strip():
+                continue
+            data = json.loads(line)
 
             # --- Annotation Processing ---
             annotations = data.get('annotations')
-            # Check if annotations is a string and load it as JSON
+            # Older files store the annotations as a JSON string instead of a list
             if isinstance(annotations, str):
                 annotations = json.loads(annotations)
+            if not annotations:
+                continue
+
+            # --- ID Parsing ---
+            parts = data['id'].split('-_')
+            year = code('year', parts[0].split('-')[0])
+            source = code('source', parts[1].split('_')[0])
+
+            for annotation in annotations:
+                raw_label = annotation['Label']
+                if raw_label not in label_codes:
+                    # Split labels by semicolon and strip whitespace
+                    label_codes[raw_label] = [code('label', normalize_label(label)) for label in raw_label.split(';')]
+                for label in label_codes[raw_label]:
+                    year_codes.append(year)
+                    source_codes.append(source)
+                    label_indices.append(label)
+
+    shape = (len(codes['year']), len(codes['source']), len(codes['label']))
+    # New years, sources and labels get new indices at the end, so the old counts keep their place
+    counts = np.pad(label_counts.counts, [(0, new - old) for old, new in zip(label_counts.counts.shape, shape)])
+    if label_indices:
+        flat = np.ravel_multi_index((year_codes, source_codes, label_indices), shape)
+        counts += np.bincount(flat, minlength=counts.size).reshape(shape)
+    return LabelCounts(counts, list(codes['year']), list(codes['source']), list(codes['label'])), offset
 
-            if annotations:
-                for annotation in annotations:
-                    # Split labels by comma and strip whitespace
-                    labels = [label.strip().replace('Metaphors', 'Metaphore').replace('Metaphore', 'Metaphor') for label in annotation['Label'].split(';')]
-                    for label in labels:
-                        labels_per_year[year][label] += 1
-                        labels_per_source[source][label] += 1
-                        all_labels.add(label)
-
-                        # --- Color Map Generation ---
-    sorted_labels = sorted(list(all_labels))
+
+def stats_cache_path(json_file_path):
+    return json_file_path + '.stats.npz'
+
+
+def file_fingerprint(json_file_path, offset):
+    """Hash of the first and the last FINGERPRINT_BYTES before offset, which change when the file is rewritten."""
+    digest = hashlib.sha1(str(offset).encode())
+    with open(json_file_path, 'rb') as f:
+        digest.update(f.read(min(offset, FINGERPRINT_BYTES)))
+        f.seek(max(0, offset - FINGERPRINT_BYTES))
+        digest.update(f.read(min(offset, FINGERPRINT_BYTES)))
+    return digest.hexdigest()
+
+
+def cached_label_counts(json_file_path):
+    """
+    The LabelCounts of a JSONL that only grows by appending, kept up to date in a cache file next to it.
+    The cache stores the counts with the byte offset they were computed up to and a fingerprint of
+    the file at that point; a refresh only reads what was appended since. If the file is shorter
+    than the offset or the fingerprint no longer matches, the counts are rebuilt from scratch.
+    """
+    cache_path = stats_cache_path(json_file_path)
+    label_counts, offset = None, 0
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path, allow_pickle=False) as cache:
+                cached_offset = int(cache['offset'])
+                if (cached_offset <= os.path.getsize(json_file_path)
+                        and str(cache['fingerprint']) == file_fingerprint(json_file_path, cached_offset)):
+                    label_counts = LabelCounts(cache['counts'], cache['years'].tolist(),
+                                               cache['sources'].tolist(), cache['labels'].tolist())
+                    offset = cached_offset
+                else:
+                    print(f"'{json_file_path}' was truncated or rewritten, recounting all labels")
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Ignoring unreadable stats cache '{cache_path}': {e}")
+
+    previous_offset = offset
+    label_counts, offset = count_labels(json_file_path, label_counts, offset)
+    if offset != previous_offset or not os.path.exists(cache_path):
+        temp_path = cache_path + '.tmp.npz'
+        np.savez(temp_path, counts=label_counts.counts, years=np.array(label_counts.years, dtype=str),
+                 sources=np.array(label_counts.sources, dtype=str), labels=np.array(label_counts.labels, dtype=str),
+                 offset=offset, fingerprint=file_fingerprint(json_file_path, offset))
+        os.replace(temp_path, cache_path)
+    return label_counts
+
+
+def color_map_for(labels):
+    # --- Color Map Generation ---
+    sorted_labels = sorted(list(labels))
     num_labels = len(sorted_labels)
 
     if num_labels > 0:
         # Generate a list of unique colors using a perceptually uniform colormap
         # 'turbo' is excellent for creating many visually distinct colors
-        colors = plt.cm.turbo(np.linspace(0, 1, num_labels))
+        colors = pyplot().cm.turbo(np.linspace(0, 1, num_labels))
         # Create a dictionary to map each label to a specific color
-        color_map = dict(zip(sorted_labels, colors))
-    else:
-        color_map = {}
-    if not distrib:
-        # --- Data Conversion for Plotting ---
-        # Convert nested dictionaries to DataFrames
-        df_year = pd.DataFrame.from_dict(labels_per_year, orient='index').fillna(0)
-        df_year = df_year.sort_index()
-        df_source = pd.DataFrame.from_dict(labels_per_source, orient='index').fillna(0)
-
-        # --- Plotting ---
-        # Plot for labels per year
-        if not df_year.empty:
-            plot_colors = [color_map[label] for label in df_year.columns]
-            df_year.plot(kind='bar', stacked=True, figsize=(15, 8), color=plot_colors)
-            plt.title('Number of Different Labels per Year')
-            plt.xlabel('Year')
-            plt.ylabel('Number of Labels')
-            plt.xticks(rotation=45)
-            plt.legend(title='Labels', bbox_to_anchor=(1.05, 1), loc='upper left')
-            plt.tight_layout()
-            if not decade:
-                plt.savefig('year_count_' + lang + '.png')
-            else:
-                plt.savefig('decade_count_' + lang + '.png')
-
-        # Plot for labels per source
-        if not df_source.empty:
-            plot_colors = [color_map[label] for label in df_source.columns]
-            df_source.plot(kind='bar', stacked=True, figsize=(15, 8), color=plot_colors)
-            plt.title('Number of Different Labels per Source')
-            plt.xlabel('Source')
-            plt.ylabel('Number of Labels')
-            plt.xticks(rotation=45)
-            plt.legend(title='Labels', bbox_to_anchor=(1.05, 1), loc='upper left')
-            plt.tight_layout()
-            plt.savefig('source_count_' + lang + '.png')
-    else:
-
-        df_year = pd.DataFrame.from_dict(labels_per_year, orient='index').fillna(0)
-        df_year = df_year.sort_index()
-        # Normalize the data to get the distribution (percentage)
-        df_year_dist = df_year.div(df_year.sum(axis=1), axis=0) * 100
-
-        df_source = pd.DataFrame.from_dict(labels_per_source, orient='index').fillna(0)
-        # Normalize the data to get the distribution (percentage)
-        df_source_dist = df_source.div(df_source.sum(axis=1), axis=0) * 100
-
-        # --- Plotting ---
-        # Plot for label distribution per year
-        if not df_year_dist.empty:
-            plot_colors = [color_map[label] for label in df_year_dist.columns]
-            df_year_dist.plot(kind='bar', stacked=True, figsize=(15, 8), color=plot_colors)
-            plt.title('Distribution of Annotation Labels per Year')
-            plt.xlabel('Year')
-            plt.ylabel('Distribution of Labels (%)')
-            plt.xticks(rotation=45, ha="right")
-            # Move the legend outside of the plot
-            plt.legend(title='Labels', bbox_to_anchor=(1.05, 1), loc='upper left')
-            plt.tight_layout()
-            if not decade:
-                plt.savefig('year_distrib_' + lang + '.png')
-            else:
-                plt.savefig('decade_distrib_' + lang + '.png')
-
-        # Plot for label distribution per source
-        if not df_source_dist.empty:
-            plot_colors = [color_map[label] for label in df_source_dist.columns]
-            df_source_dist.plot(kind='bar', stacked=True, figsize=(15, 8), color=plot_colors)
-            plt.title('Distribution of Annotation Labels per Source')
-            plt.xlabel('Source')
-            plt.ylabel('Distribution of Labels (%)')
-            plt.xticks(rotation=45, ha="right")
-            # Move the legend outside of the plot
-            plt.legend(title='Labels', bbox_to_anchor=(1.05, 1), loc='upper left')
-            plt.tight_layout()
-            plt.savefig('source_distrib_' + lang + '.png')
-
-
-analyze_corpus("articles_de_corpus_annotated.jsonl", lang='de', distrib=False, decade=False)
-analyze_corpus("articles_ch_corpus_annotated.jsonl", lang='ch', distrib=False, decade=False)
-analyze_corpus("articles_en_corpus_annotated.jsonl", lang='en', distrib=False, decade=False)
-analyze_corpus("articles_fr_corpus_annotated.jsonl", lang='fr', distrib=False, decade=False)
+        return dict(zip(sorted_labels, colors))
+    return {}
+
+
+def chart_tables(label_counts, charts=CHARTS):
+    """The table behind every chart: label counts per year, decade or source, or their distribution (%)."""
+    tables = {}
+    for name in charts:
+        view, kind = name.split('_')
+        df = label_counts.per_source() if view == 'source' else label_counts.per_year(decade=view == 'decade')
+        if kind == 'distrib':
+            # Normalize the data to get the distribution (percentage)
+            df = df.div(df.sum(axis=1), axis=0) * 100
+        tables[name] = df
+    return tables
+
+
+def render_chart(df, name, color_map, output_path):
+    """Draw one stacked bar chart into output_path and close its figure."""
+    title, xlabel, ylabel = CHARTS[name]
+    plt = pyplot()
+    fig, ax = plt.subplots(figsize=(15, 8))
+    try:
+        plot_colors = [color_map[label] for label in df.columns]
+        df.plot(kind='bar', stacked=True, ax=ax, color=plot_colors)
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        if name.endswith('distrib'):
+            plt.setp(ax.get_xticklabels(), rotation=45, ha="right")
+        else:
+            plt.setp(ax.get_xticklabels(), rotation=45)
+        # Move the legend outside of the plot
+        ax.legend(title='Labels', bbox_to_anchor=(1.05, 1), loc='upper left')
+        fig.tight_layout()
+        fig.savefig(output_path)
+    finally:
+        plt.close(fig)
+    return output_path
+
+
+def render_all(tables_per_lang, output_dir=STATS_DIR, workers=None):
+    """
+    Render the charts of every language in a process pool, one chart per task.
+    tables_per_lang maps a language to its chart tables (see chart_tables); the charts of a
+    language are written to output_dir with {lang} filled in, as <chart>_<lang>.png.
+    """
+    tasks = []
+    for lang, tables in tables_per_lang.items():
+        directory = output_dir.format(lang=lang)
+        os.makedirs(directory, exist_ok=True)
+        labels = set()
+        for df in tables.values():
+            labels.update(df.columns)
+        color_map = color_map_for(labels)
+        for name, df in tables.items():
+            if not df.empty:
+                tasks.append((df, name, color_map, os.path.join(directory, name + '_' + lang + '.png')))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render_chart, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def analyze_corpus(json_file_path, lang, distrib, decade, label_counts=None, output_dir=STATS_DIR):
+    """
+    Plot the labels per year (or decade) and per source, as counts or as distributions.
+    Pass the LabelCounts of the file as label_counts to draw several views from a single read.
+    """
+    if label_counts is None:
+        label_counts, _ = count_labels(json_file_path)
+    kind = 'distrib' if distrib else 'count'
+    names = [('decade_' if decade else 'year_') + kind, 'source_' + kind]
+    directory = output_dir.format(lang=lang)
+    os.makedirs(directory, exist_ok=True)
+    color_map = color_map_for(label_counts.labels)
+    for name, df in chart_tables(label_counts, names).items():
+        if not df.empty:
+            render_chart(df, name, color_map, os.path.join(directory, name + '_' + lang + '.png'))
+
+
+def main(languages=('de', 'ch', 'en', 'fr'), input_pattern=ANNOTATED_JSONL, output_dir=STATS_DIR, workers=None):
+    tables_per_lang = {}
+    for lang in languages:
+        json_file_path = input_pattern.format(lang=lang)
+        # Only the articles appended since the last run are read; the rest comes from the stats cache
+        label_counts = cached_label_counts(json_file_path)
+        tables_per_lang[lang] = chart_tables(label_counts)
+    for path in render_all(tables_per_lang, output_dir, workers):
+        print("Saved", path)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Chart the annotation labels per year, decade and source")
+    parser.add_argument('languages', nargs='*', choices=['de', 'ch', 'en', 'fr'], default=['de', 'ch', 'en', 'fr'],
+                        help="Languages to analyse (default: all)")
+    parser.add_argument('--input-pattern', default=ANNOTATED_JSONL, help="Annotated JSONL, {lang} is the language code")
+    parser.add_argument('--output-dir', default=STATS_DIR, help="Chart directory, {lang} is the language code")
+    parser.add_argument('--workers', type=int, default=None, help="Number of rendering processes (default: all cores)")
+    parser.add_argument('--table', choices=list(CHARTS), help="Print this table instead of rendering the charts")
+    return parser
+
+
+def run(args):
+    if args.table:
+        for lang in args.languages:
+            label_counts = cached_label_counts(args.input_pattern.format(lang=lang))
+            print(f"--- {args.table} ({lang}) ---")
+            print(chart_tables(label_counts, [args.table])[args.table].to_string())
+        return
+    main(args.languages, args.input_pattern, args.output_dir, args.workers)
+
+
+if __name__ == '__main__':
+    run(build_parser().parse_args())
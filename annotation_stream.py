@@ -0,0 +1,68 @@
+# A streamed response is cancelled once this many consecutive non-empty lines are neither
+# a Label: nor a Text: line (None never cancels)
+MAX_OFF_FORMAT_LINES = 5
+
+
+class OffFormatResponse(Exception):
+    """Raised when a streamed response does not follow the Label:/Text: format."""
+
+
+class AnnotationStreamParser:
+    """
+    Parses Label:/Text: pairs out of a response that arrives in chunks.
+
+    feed() returns the pairs completed by a chunk, so they can be aligned while the rest of the
+    response is still being generated; a line is only parsed once its newline has arrived.
+    A Text: line is paired with the Label: line directly before it, blank lines aside.
+    """
+
+    def __init__(self, max_off_format_lines=MAX_OFF_FORMAT_LINES):
+        self.max_off_format_lines = max_off_format_lines
+        self.buffer = ""
+        self.label = None
+        self.off_format_lines = 0
+
+    def parse_line(self, line):
+        line = line.strip()
+        if not line:
+            return None
+        if line.startswith("Label:"):
+            self.label = line.replace("Label:", "").strip()
+            self.off_format_lines = 0
+            return None
+        if line.startswith("Text:") and self.label is not None:
+            label = self.label
+            self.label = None
+            self.off_format_lines = 0
+            text = line.replace("Text:", "").strip()
+            # Remove potential surrounding quotes from the text to search for
+            if text.startswith('"') and text.endswith('"'):
+                text = text[1:-1]
+            return label, text
+        self.label = None
+        self.off_format_lines += 1
+        if self.max_off_format_lines is not None and self.off_format_lines >= self.max_off_format_lines:
+            raise OffFormatResponse(f"{self.off_format_lines} consecutive lines outside the Label:/Text: format")
+        return None
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        *lines, self.buffer = self.buffer.split('\n')
+        pairs = []
+        for line in lines:
+            pair = self.parse_line(line)
+            if pair is not None:
+                pairs.append(pair)
+        return pairs
+
+    def close(self):
+        """Pairs completed by the last, unterminated line of the response."""
+        line, self.buffer = self.buffer, ""
+        pair = self.parse_line(line)
+        return [pair] if pair is not None else []
+
+
+def parse_annotation_pairs(annotations_str):
+    """All (label, text) pairs of a complete response."""
+    parser = AnnotationStreamParser(max_off_format_lines=None)
+    return parser.feed(annotations_str) + parser.close()
@@ -0,0 +1,89 @@
+import re
+
+from token_utils import estimate_tokens
+
+BATCH_INSTRUCTIONS = (
+    "Several numbered news articles are given below. Annotate each of them separately in the same manner "
+    "as in the examples above. Start the annotations of every article with the line "
+    "'=== Annotations for article <number> ===' and follow it with the annotations of that article only. "
+    "Return only annotations and nothing else. Do not change the extracted text in any way.\n"
+)
+
+class MissingAnnotations(Exception):
+    """Recorded for the members of a packed prompt whose annotations are missing from the response."""
+
+
+ANNOTATIONS_HEADER = re.compile(r'^\s*=+\s*Annotations for article\s+(\d+)\s*=+\s*$', re.MULTILINE | re.IGNORECASE)
+
+
+def build_batch_prompt(prefix, documents, examples=()):
+    # examples are chosen for the whole batch (see exemplar_retrieval.add_examples)
+    prompt = prefix + "\n".join(examples) + BATCH_INSTRUCTIONS
+    for k, document in enumerate(documents, start=1):
+        prompt += f"\n=== Article {k} ===\n"
+        prompt += document['article']
+        prompt += "\n"
+    prompt += "\n--- Annotations ---\n"
+    return prompt
+
+
+def pack_documents(documents, prefix, token_budget, max_articles=10):
+    """
+    Pack consecutive short articles into one prompt, as long as their combined size stays
+    within token_budget and there are at most max_articles of them.
+
+    prefix is put in front of every packed prompt ("" when the instructions are served from the
+    prefix cache). Articles that are too long to share a prompt, and near-duplicates that are not
+    sent to the model at all ('duplicate_of'), are yielded unchanged.
+    A packed document keeps the original documents under 'members', so the response can be
+    split back per article; its prompt is built by build_batch_prompt when it is sent, after
+    examples have been chosen for it. Documents sent alone are marked 'alone', as the
+    instructions of a packing run stop before the closing sentence and build_prompt has to add it.
+    """
+    batch = []
+    batch_tokens = 0
+
+    def flush():
+        if len(batch) == 1:
+            return dict(batch[0], alone=True)
+        # Routing fields such as prefix_name and output_path are shared by all members
+        packed = dict(batch[0])
+        packed.update({
+            'id': batch[0]['id'] + ' (+' + str(len(batch) - 1) + ')',
+            'batch_prefix': prefix,
+            'article': None,
+            'members': list(batch),
+        })
+        return packed
+
+    for document in documents:
+        tokens = estimate_tokens(document['article'])
+        if 'duplicate_of' in document:
+            yield document
+            continue
+        if tokens > token_budget:
+            yield dict(document, alone=True)
+            continue
+        if batch and (batch_tokens + tokens > token_budget or len(batch) >= max_articles):
+            yield flush()
+            batch = []
+            batch_tokens = 0
+        batch.append(document)
+        batch_tokens += tokens
+    if batch:
+        yield flush()
+
+
+def split_batched_response(response_text, n):
+    """
+    Split the response to a packed prompt into the annotation strings of its n articles.
+    Articles whose header is missing from the response are returned as None.
+    """
+    parts = [None] * n
+    headers = list(ANNOTATIONS_HEADER.finditer(response_text))
+    for h, header in enumerate(headers):
+        k = int(header.group(1))
+        end = headers[h + 1].start() if h + 1 < len(headers) else len(response_text)
+        if 1 <= k <= n:
+            parts[k - 1] = response_text[header.end():end].strip()
+    return parts
@@ -0,0 +1,145 @@
+"""
+End-to-end throughput benchmark of the annotation pipeline against the offline FakeClient.
+
+Runs the full scheduler -> rate limiter -> parser/alignment -> writer path on a synthetic corpus
+and reports articles/sec, request latency percentiles and the CPU time spent outside the
+(simulated) network. No API key or quota is needed.
+
+    python benchmark.py --articles 10000 --latency-median 0.2 --quota-error-rate 0.01
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import gemini_api
+from batching import pack_documents
+from fake_gemini import FakeClient
+from prefix_cache import create_prefix_cache
+from segmentation import split_long_documents
+from rate_limiter import AdaptiveRateLimiter
+from request_metrics import RequestMetrics
+
+WORDS = (
+    "children factory work school law hours wages mill parents inspector labor government "
+    "education health poverty machine strike union reform mine street employer age night"
+).split()
+
+
+def synthetic_article(rng, min_sentences=1, max_sentences=20):
+    sentences = []
+    for _ in range(rng.randint(min_sentences, max_sentences)):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(5, 25))]
+        sentences.append(" ".join(words).capitalize() + ".")
+    return " ".join(sentences)
+
+
+def synthetic_corpus(n, seed=0, min_sentences=1, max_sentences=20):
+    rng = random.Random(seed)
+    for i in range(n):
+        yield f"{1890 + i % 60}-01-01-_source{i % 4}_{i}", synthetic_article(rng, min_sentences, max_sentences)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def run_benchmark(args):
+    client = FakeClient(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        quota_error_rate=args.quota_error_rate,
+        seed=args.seed,
+    )
+    gemini_api.MAX_IN_FLIGHT = args.max_in_flight
+    gemini_api.STREAM_RESPONSES = not args.no_stream
+    gemini_api.api_rate_limiter = AdaptiveRateLimiter(
+        args.requests_per_minute, args.tokens_per_minute, backoff_base=args.backoff_base
+    )
+    prefix_cache = create_prefix_cache(args.prefix_cache, client)
+    instructions = "Synthetic instructions and few-shot examples.\n" * (args.prefix_chars // 46)
+    prefix_name = prefix_cache.register(gemini_api.MODEL_NAME, instructions) if prefix_cache else None
+
+    # Same lazy reader -> document -> packing chain as the annotation scripts
+    articles = synthetic_corpus(args.articles, args.seed, max_sentences=args.max_sentences)
+    requests = gemini_api.iter_documents(articles, instructions, prefix_name)
+    if args.max_article_tokens:
+        requests = split_long_documents(requests, args.max_article_tokens, gemini_api.SEGMENT_OVERLAP_TOKENS)
+    if args.batch_token_budget:
+        requests = pack_documents(requests, instructions if prefix_cache is None else "", args.batch_token_budget)
+
+    # Measure every request from the moment it is scheduled, so limiter waits and retries are included
+    latencies = []
+    process_document = gemini_api.process_document
+
+    async def timed_process_document(*a, **kw):
+        start = time.perf_counter()
+        try:
+            return await process_document(*a, **kw)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    gemini_api.process_document = timed_process_document
+    output_path = os.path.join(tempfile.mkdtemp(), "benchmark_annotated.jsonl")
+    metrics = RequestMetrics(args.metrics)
+    loop = asyncio.new_event_loop()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        loop.run_until_complete(gemini_api.process_grouped_documents(
+            enumerate(requests), output_path, client, prefix_cache, total=args.articles, metrics=metrics
+        ))
+    finally:
+        gemini_api.process_document = process_document
+        loop.close()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    with open(output_path, 'r', encoding='utf-8') as f:
+        written = sum(1 for _ in f)
+    os.remove(output_path)
+
+    print("\n--- Benchmark results ---")
+    print(f"Articles: {args.articles}  Requests: {client.stats['calls']}  Written: {written}")
+    print(f"Wall time: {wall:.2f}s  Throughput: {written / wall:.1f} articles/s")
+    print(f"Request latency p50/p95/p99: {percentile(latencies, 50):.3f}s / "
+          f"{percentile(latencies, 95):.3f}s / {percentile(latencies, 99):.3f}s")
+    print(f"CPU time outside the network: {cpu:.2f}s ({1000 * cpu / max(written, 1):.2f} ms per article)")
+    print(f"Fake client: {client.stats}")
+    print(metrics.summary())
+    metrics.close()
+    print(gemini_api.api_rate_limiter.summary())
+    if prefix_cache is not None:
+        print(prefix_cache.summary())
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark of the annotation pipeline")
+    parser.add_argument('--articles', type=int, default=1000)
+    parser.add_argument('--max-sentences', type=int, default=20)
+    parser.add_argument('--latency-median', type=float, default=0.5, help="Median simulated API latency (s)")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="Log-normal spread of the latency")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--quota-error-rate', type=float, default=0.0, help="Share of calls answered with a 429")
+    parser.add_argument('--max-in-flight', type=int, default=gemini_api.MAX_IN_FLIGHT)
+    parser.add_argument('--requests-per-minute', type=int, default=60000)
+    parser.add_argument('--tokens-per-minute', type=int, default=10 ** 9)
+    parser.add_argument('--backoff-base', type=float, default=0.1)
+    parser.add_argument('--prefix-cache', choices=['local', 'gemini', 'none'], default='local')
+    parser.add_argument('--prefix-chars', type=int, default=40000)
+    parser.add_argument('--batch-token-budget', type=int, default=None)
+    parser.add_argument('--max-article-tokens', type=int, default=None, help="Split longer articles into segments")
+    parser.add_argument('--no-stream', action='store_true', help="Wait for complete responses instead of streaming")
+    parser.add_argument('--metrics', default=None, help="Also write the per-request metrics to this JSONL file")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+if __name__ == '__main__':
+    run_benchmark(build_parser().parse_args())
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+
+# Bytes at the start of the output that are fingerprinted in the manifest; appending lines never changes them
+FINGERPRINT_BYTES = 4096
+
+
+class Checkpoint:
+    """
+    Keeps track of which article ids already have a line in the output JSONL, so an
+    interrupted annotation run can be restarted without paying for finished articles again.
+
+    The completed ids are kept in a sidecar manifest (one id per line, next to the output file).
+    Every write to the manifest also records the size of the output and a fingerprint of its first
+    bytes ('#' lines). If the manifest is missing, or the output has since shrunk or been rewritten,
+    the manifest is rebuilt from the output JSONL itself.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.manifest_path = output_path + '.done'
+        self.manifest_file = None
+        self.completed = set()
+        self.fingerprint = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.output_path):
+            # Output was removed to start from scratch, so an old manifest no longer applies
+            if os.path.exists(self.manifest_path):
+                os.remove(self.manifest_path)
+            return
+        self._repair_output_tail()
+        if os.path.exists(self.manifest_path):
+            recorded = None
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.startswith('#'):
+                        recorded = line[1:].split()
+                    elif line.strip():
+                        self.completed.add(line.rstrip('\n'))
+            if recorded is not None and self._matches(int(recorded[0]), recorded[1]):
+                # Output lines are flushed before their manifest entries, so the last batch may be missing from it
+                missing = self._unmarked_output_ids()
+                if missing:
+                    self.mark_many(missing)
+                return
+            print(f"Output '{self.output_path}' changed since its manifest was written, rebuilding the manifest")
+            self.completed = set()
+        with open(self.output_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    self.completed.add(json.loads(line)['id'])
+        with open(self.manifest_path, 'w', encoding='utf-8') as f:
+            for article_id in self.completed:
+                f.write(article_id + '\n')
+            f.write(self._record())
+
+    def _head_fingerprint(self, size):
+        with open(self.output_path, 'rb') as f:
+            return hashlib.sha256(f.read(min(size, FINGERPRINT_BYTES))).hexdigest()[:16]
+
+    def _matches(self, size, fingerprint):
+        """Whether the output still starts with what it held when the manifest was last written."""
+        return os.path.getsize(self.output_path) >= size and self._head_fingerprint(size) == fingerprint
+
+    def _record(self):
+        """Manifest line with the current size of the output and the fingerprint of its first bytes."""
+        size = os.path.getsize(self.output_path)
+        # The fingerprint only changes until the output is FINGERPRINT_BYTES long
+        if self.fingerprint is None or self.fingerprint[0] < FINGERPRINT_BYTES:
+            self.fingerprint = (size, self._head_fingerprint(size))
+        return f"#{size} {self.fingerprint[1]}\n"
+
+    def _repair_output_tail(self):
+        # A crash in the middle of a write leaves a partial last line; cut it off so new lines stay valid JSONL
+        with open(self.output_path, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            position = _line_start(f, size)
+            print(f"Removing incomplete last line of '{self.output_path}' ({size - position} bytes)")
+            f.truncate(position)
+
+    def _unmarked_output_ids(self):
+        """Ids of the lines at the end of the output that are not in the manifest, read backwards."""
+        missing = []
+        with open(self.output_path, 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = _line_start(f, end - 1)
+                f.seek(start)
+                article_id = json.loads(f.readline())['id']
+                if article_id in self.completed:
+                    break
+                missing.append(article_id)
+                end = start
+        return missing
+
+    def is_done(self, article_id):
+        return article_id in self.completed
+
+    def mark(self, article_id):
+        self.mark_many([article_id])
+
+    def mark_many(self, article_ids):
+        """Record several completed ids with a single write."""
+        if self.manifest_file is None:
+            self.manifest_file = open(self.manifest_path, 'a', encoding='utf-8')
+        self.manifest_file.write(''.join(article_id + '\n' for article_id in article_ids) + self._record())
+        self.manifest_file.flush()
+        self.completed.update(article_ids)
+
+    def close(self):
+        if self.manifest_file is not None:
+            self.manifest_file.close()
+            self.manifest_file = None
+
+
+def _line_start(f, end):
+    """Byte offset where the line containing position end - 1 starts, scanning backwards in blocks."""
+    position = end
+    while position > 0:
+        step = min(65536, position)
+        position -= step
+        f.seek(position)
+        last_newline = f.read(step).rfind(b'\n')
+        if last_newline != -1:
+            return position + last_newline + 1
+    return 0
@@ -0,0 +1,46 @@
+"""
+Single entry point for the annotation, export and analysis scripts.
+
+    python cli.py annotate english french
+    python cli.py replay --max-retries 6
+    python cli.py convert en
+    python cli.py analyse en --table decade_count
+    python cli.py triage results/articles_de_corpus_annotated.jsonl --language german
+    python cli.py benchmark --articles 1000
+
+Only the module of the chosen subcommand is imported, so e.g. convert never loads
+pandas, matplotlib or the Gemini SDK. Every subcommand takes the arguments of its
+script; see python cli.py <command> --help.
+"""
+import argparse
+import importlib
+import sys
+
+# Subcommand -> (module, function that runs the parsed arguments, help)
+COMMANDS = {
+    'annotate': ('gemini_api_all', 'run', "Annotate the corpora with Gemini"),
+    'replay': ('replay', 'replay', "Re-submit the articles of failed requests"),
+    'convert': ('convert_to_json', 'run', "Export annotated JSONL files as formatted JSON"),
+    'analyse': ('analyse_annotations', 'run', "Chart the annotation labels per year, decade and source"),
+    'triage': ('triage', 'run', "Check the triage rules against an annotated corpus"),
+    'benchmark': ('benchmark', 'run_benchmark', "Offline throughput benchmark of the annotation pipeline"),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analysis of child labor in the historical press")
+    subparsers = parser.add_subparsers(dest='command', required=True, metavar='command')
+    for name, (module, function, help) in COMMANDS.items():
+        # The options of a subcommand belong to its script's parser, which is only imported when it runs
+        subparsers.add_parser(name, help=help, add_help=False)
+    args, rest = parser.parse_known_args(argv)
+
+    module_name, function, help = COMMANDS[args.command]
+    module = importlib.import_module(module_name)
+    command_parser = module.build_parser()
+    command_parser.prog = f"{parser.prog} {args.command}"
+    getattr(module, function)(command_parser.parse_args(rest))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
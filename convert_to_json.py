@@ -1,12 +1,29 @@
+import argparse
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Annotated JSONL of every language and the formatted JSON it is exported to
+EXPORTS = {
+    lang: (f'results/articles_{lang}_corpus_annotated.jsonl',
+           f'results/articles_{lang}_corpus_annotated_gemini_2.5_pro.json')
+    for lang in ['en', 'ch', 'de', 'fr']
+}
 
 
 def convert_jsonl_to_formatted_json(input_file_path, output_file_path):
-    all_records = []
+    """
+    Export a JSONL file as one indented JSON array. Records are written one at a time as they
+    are read, so memory use does not grow with the size of the file; the output is written under
+    a temporary name and only replaces output_file_path once the whole input has been converted.
+    """
+    temp_path = output_file_path + '.tmp'
+    count = 0
 
     try:
         # Open the input JSONL file and read it line by line
-        with open(input_file_path, 'r', encoding='utf-8') as f_in:
+        with open(input_file_path, 'r', encoding='utf-8') as f_in, open(temp_path, 'w', encoding='utf-8') as f_out:
+            f_out.write('[')
             for line in f_in:
                 # Skip any empty lines in the file
                 if not line.strip():
@@ -15,7 +32,7 @@ def convert_jsonl_to_formatted_json(input_file_path, output_file_path):
                 # Load the JSON object from the current line
                 record = json.loads(line)
 
-                # The 'annotations' value is a string, so we need to parse it separately
+                # Files written before the annotations were stored as nested lists hold them as a string
                 if 'annotations' in record and isinstance(record['annotations'], str):
                     annotations_string = record['annotations']
                     # Parse the string into a Python list of dictionaries
@@ -23,15 +40,14 @@ def convert_jsonl_to_formatted_json(input_file_path, output_file_path):
                     # Replace the original string with the new list
                     record['annotations'] = annotations_list
 
-                all_records.append(record)
-
-        # Open the output file to write the final, formatted JSON
-        with open(output_file_path, 'w', encoding='utf-8') as f_out:
-            # Dump the list of all records into a single JSON array
-            # The 'indent=4' argument makes the output human-readable
-            json.dump(all_records, f_out, indent=4, ensure_ascii=False)
+                # Same layout as json.dump(all_records, indent=4): every record indented one level
+                formatted = json.dumps(record, indent=4, ensure_ascii=False).replace('\n', '\n    ')
+                f_out.write((',\n    ' if count else '\n    ') + formatted)
+                count += 1
+            f_out.write('\n]' if count else ']')
 
-        print(f"Successfully converted '{input_file_path}' to '{output_file_path}'.")
+        os.replace(temp_path, output_file_path)
+        print(f"Successfully converted '{input_file_path}' to '{output_file_path}' ({count} records).")
 
     except FileNotFoundError:
         print(f"Error: The file '{input_file_path}' was not found.")
@@ -39,8 +55,35 @@ def convert_jsonl_to_formatted_json(input_file_path, output_file_path):
         print(f"Error decoding JSON. Please check file format. Details: {e}")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def convert_all(languages, workers=None):
+    """Export several languages at once, each in its own process."""
+    with ProcessPoolExecutor(max_workers=workers or len(languages)) as executor:
+        futures = [executor.submit(convert_jsonl_to_formatted_json, *EXPORTS[lang]) for lang in languages]
+        for future in futures:
+            future.result()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Export annotated JSONL files as formatted JSON")
+    parser.add_argument('languages', nargs='*', choices=list(EXPORTS), default=list(EXPORTS),
+                        help="Languages to export (default: all)")
+    parser.add_argument('--input', help="Export this JSONL file instead of the language results")
+    parser.add_argument('--output', help="Output JSON file for --input")
+    parser.add_argument('--workers', type=int, default=None, help="Number of processes (default: one per language)")
+    return parser
+
+
+def run(args):
+    if args.input:
+        convert_jsonl_to_formatted_json(args.input, args.output or os.path.splitext(args.input)[0] + '.json')
+    else:
+        convert_all(args.languages, args.workers)
+
 
-convert_jsonl_to_formatted_json('results/articles_en_corpus_annotated.jsonl', 'results/articles_en_corpus_annotated_gemini_2.5_pro.json')
-convert_jsonl_to_formatted_json('results/articles_ch_corpus_annotated.jsonl', 'results/articles_ch_corpus_annotated_gemini_2.5_pro.json')
-convert_jsonl_to_formatted_json('results/articles_de_corpus_annotated.jsonl', 'results/articles_de_corpus_annotated_gemini_2.5_pro.json')
-convert_jsonl_to_formatted_json('results/articles_fr_corpus_annotated.jsonl', 'results/articles_fr_corpus_annotated_gemini_2.5_pro.json')
\ No newline at end of file
+if __name__ == '__main__':
+    run(build_parser().parse_args())
@@ -0,0 +1,83 @@
+import json
+import os
+import time
+
+
+class RequestFailed(Exception):
+    """Raised by process_document when a request still fails after its last retry."""
+
+    def __init__(self, document, error, attempts):
+        super().__init__(f"Error after {attempts} attempts: {error}")
+        self.document = document
+        self.error = error
+        self.attempts = attempts
+
+
+def failed_articles(document):
+    """
+    The articles lost with a failed request: every member of a packed prompt, the whole article of a
+    segment, and the near-duplicates that were waiting for the annotations of one of them.
+    Every article is yielded once, however many of its segments fail (in this or later requests).
+    """
+    for member in document.get('members', [document]):
+        article = member.get('parent', member)
+        if article.get('failed'):
+            continue
+        article['failed'] = True
+        yield article
+        if 'cluster' in article:
+            yield from article['cluster'].fail()
+
+
+class DeadLetterQueue:
+    """
+    Appends the articles of requests that failed for good to a JSONL file, one line per article
+    with the error class, the error message and the number of attempts, so they can be replayed
+    later without re-running the corpus.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.stats = {'requests': 0, 'articles': 0}
+
+    def add(self, document, output_path, error, attempts):
+        if self.file is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.stats['requests'] += 1
+        for article in failed_articles(document):
+            entry = {
+                'id': article['id'],
+                'article': article['article'],
+                'output_path': article.get('output_path', output_path),
+                'error_class': type(error).__name__,
+                'error': str(error),
+                'attempts': attempts,
+                'failed_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+            self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.stats['articles'] += 1
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def summary(self):
+        return (f"Dead letters: {self.stats['requests']} failed requests, "
+                f"{self.stats['articles']} articles written to {self.path}")
+
+
+def read_dead_letters(path):
+    """The entries of a dead-letter file, skipping a partially written last line."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
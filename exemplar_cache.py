@@ -0,0 +1,41 @@
+import hashlib
+import json
+import os
+
+# Compiled tag sets and exemplars are stored here (None compiles them on every run)
+EXEMPLAR_CACHE_DIR = "cache/exemplars"
+
+
+def source_fingerprint(paths):
+    """Fingerprint of a set of source files from their paths, sizes and modification times."""
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def load_compiled(name, sources, compile_source, cache_dir=EXEMPLAR_CACHE_DIR):
+    """
+    The JSON-serialisable result of compile_source() for the given source files. It is stored
+    under name together with the fingerprint of the sources, and only compiled again when one of
+    them was added, removed or changed since.
+    """
+    if cache_dir is None:
+        return compile_source()
+    fingerprint = source_fingerprint(sources)
+    path = os.path.join(cache_dir, hashlib.sha1(name.encode()).hexdigest()[:16] + '.json')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            artifact = json.load(f)
+        if artifact['name'] == name and artifact['fingerprint'] == fingerprint:
+            return artifact['value']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    value = compile_source()
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'name': name, 'fingerprint': fingerprint, 'value': value}, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+    return value
@@ -0,0 +1,109 @@
+"""
+Per-article choice of the worked examples that go into a prompt.
+
+All annotated examples of a language are put in a TF-IDF index when a run starts. Every article
+then gets the examples most similar to it, as many as fit a token budget, in place of the same
+first few for every article. The index is a dense NumPy matrix (there are only a few dozen
+examples), so choosing the examples of an article is a single matrix-vector product.
+"""
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+from token_utils import estimate_tokens
+
+# Words, and single characters of Chinese (which has no spaces between words)
+TOKEN_PATTERN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff]|\w+')
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class ExemplarIndex:
+    """
+    TF-IDF index over worked examples. exemplars is a list of (article text, example prompt) pairs;
+    select() returns the prompts of up to k examples most similar to an article whose estimated
+    size adds up to at most token_budget tokens.
+    """
+
+    def __init__(self, exemplars, k=3, token_budget=3000):
+        self.k = k
+        self.token_budget = token_budget
+        self.prompts = [prompt for _, prompt in exemplars]
+        self.tokens = np.array([estimate_tokens(prompt) for prompt in self.prompts])
+
+        term_counts = [Counter(tokenize(text)) for text, _ in exemplars]
+        self.vocabulary = {}
+        for counts in term_counts:
+            for term in counts:
+                self.vocabulary.setdefault(term, len(self.vocabulary))
+        tf = np.zeros((len(exemplars), len(self.vocabulary)), dtype=np.float32)
+        for row, counts in enumerate(term_counts):
+            for term, count in counts.items():
+                tf[row, self.vocabulary[term]] = 1 + math.log(count)
+        document_frequency = np.count_nonzero(tf, axis=0)
+        self.idf = (np.log((1 + len(exemplars)) / (1 + document_frequency)) + 1).astype(np.float32)
+        weights = tf * self.idf
+        norms = np.linalg.norm(weights, axis=1, keepdims=True)
+        # Rows are unit length, so a product with an article vector ranks the examples by cosine similarity
+        self.weights = weights / np.where(norms > 0, norms, 1)
+        self.selected = 0
+        self.selected_tokens = 0
+
+    def scores(self, *articles):
+        """Similarity of every example to the articles, the sum of its cosine similarities to each of them."""
+        scores = np.zeros(len(self.prompts), dtype=np.float32)
+        for article in articles:
+            terms = [self.vocabulary[term] for term in tokenize(article) if term in self.vocabulary]
+            if not terms:
+                continue
+            # Only the columns of the terms in the article take part in the product
+            columns, counts = np.unique(terms, return_counts=True)
+            article_vector = (1 + np.log(counts)).astype(np.float32) * self.idf[columns]
+            scores += self.weights[:, columns] @ (article_vector / np.linalg.norm(article_vector))
+        return scores
+
+    def select(self, *articles):
+        """
+        The prompts of the examples most similar to the articles (all articles of a packed prompt
+        together) that fit the token budget, most similar first.
+        """
+        order = np.argsort(-self.scores(*articles), kind='stable')
+        chosen = []
+        tokens = 0
+        for i in order:
+            if len(chosen) >= self.k:
+                break
+            if tokens + self.tokens[i] <= self.token_budget:
+                chosen.append(i)
+                tokens += self.tokens[i]
+        if not chosen and len(order):
+            # Every example is over the budget on its own; one example is still better than none
+            chosen = [int(np.argmin(self.tokens))]
+            tokens = self.tokens[chosen[0]]
+        self.selected += 1
+        self.selected_tokens += int(tokens)
+        return [self.prompts[i] for i in chosen]
+
+    def summary(self):
+        if not self.selected:
+            return f"Example selection: {len(self.prompts)} examples indexed, no requests yet"
+        return (f"Example selection: {len(self.prompts)} examples indexed, "
+                f"{self.selected_tokens / self.selected:.0f} example tokens per request on average")
+
+
+def add_examples(documents, index):
+    """
+    Store the examples chosen for each request document under 'examples'; they are sent after the
+    instructions. A packed document gets one set of examples for all its members, within the same
+    token budget. Near-duplicates ('duplicate_of') are not sent, so they get none.
+    """
+    for document in documents:
+        if 'members' in document:
+            document['examples'] = index.select(*[member['article'] for member in document['members']])
+        elif 'duplicate_of' not in document:
+            document['examples'] = index.select(document['article'])
+        yield document
@@ -0,0 +1,153 @@
+import asyncio
+import itertools
+import random
+import re
+from types import SimpleNamespace
+
+from token_utils import estimate_tokens
+
+LABELS = [
+    "Economic Context", "Education", "Gender", "Government Role", "Health", "Labor Movement",
+    "Legal Framework", "Social Attitudes", "Workplace",
+]
+
+ARTICLE_MARKER = re.compile(r'(?:--- News article ---|=== Article (\d+) ===)\n')
+
+
+class FakeQuotaError(Exception):
+    code = 429
+
+
+class FakeServerError(Exception):
+    code = 500
+
+
+class FakeModels:
+    def __init__(self, client):
+        self.client = client
+
+    async def generate_content(self, model, contents, config=None):
+        return await self.client.respond(contents, config)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        return self.client.respond_stream(contents, config)
+
+
+class FakeCaches:
+    """Enough of the caches API for GeminiPrefixCache to run against the fake client."""
+
+    def __init__(self):
+        self.contents = {}
+        self.counter = itertools.count()
+
+    def create(self, model, config=None):
+        name = f"cachedContents/fake-{next(self.counter)}"
+        self.contents[name] = "".join(config.contents)
+        return SimpleNamespace(name=name)
+
+    def update(self, name, config=None):
+        if name not in self.contents:
+            raise KeyError(f"404 NOT_FOUND {name} (fake)")
+        return SimpleNamespace(name=name)
+
+    def delete(self, name, config=None):
+        self.contents.pop(name, None)
+
+
+class FakeClient:
+    """
+    Offline stand-in for genai.Client with the parts of the interface the pipeline uses.
+
+    Every call sleeps for a latency drawn from a log-normal distribution (median latency_median
+    seconds, spread latency_sigma) and then either fails (error_rate, quota_error_rate) or returns
+    a response in the Label:/Text: format. Streamed responses arrive in chunks of chunk_chars
+    characters, the first after a fifth of the latency and the rest spread over the remainder. Responses are taken in turn from canned_responses when
+    given, otherwise synthesised by picking sentences from the article(s) in the prompt.
+    """
+
+    def __init__(self, latency_median=0.5, latency_sigma=0.5, error_rate=0.0, quota_error_rate=0.0,
+                 annotations_per_article=3, canned_responses=None, chunk_chars=40, seed=None):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.quota_error_rate = quota_error_rate
+        self.annotations_per_article = annotations_per_article
+        self.chunk_chars = chunk_chars
+        self.canned_responses = itertools.cycle(canned_responses) if canned_responses else None
+        self.random = random.Random(seed)
+        self.latencies = []
+        self.stats = {'calls': 0, 'errors': 0, 'quota_errors': 0}
+        self.caches = FakeCaches()
+        self.aio = SimpleNamespace(models=FakeModels(self), caches=self.caches, aclose=self._aclose)
+
+    async def _aclose(self):
+        pass
+
+    def _latency(self):
+        if self.latency_median <= 0:
+            return 0.0
+        return self.latency_median * self.random.lognormvariate(0, self.latency_sigma)
+
+    def _prompt_text(self, contents, config):
+        prompt = "".join(contents)
+        cached_content = getattr(config, 'cached_content', None)
+        if cached_content:
+            prompt = self.caches.contents.get(cached_content, "") + prompt
+        return prompt
+
+    def synthesise(self, prompt):
+        # Only the part after the last instructions holds the article(s) to annotate
+        markers = list(ARTICLE_MARKER.finditer(prompt))
+        batched = [m for m in markers if m.group(1)]
+        if batched:
+            markers = batched
+        else:
+            markers = markers[-1:]
+        blocks = []
+        for m, marker in enumerate(markers):
+            end = markers[m + 1].start() if m + 1 < len(markers) else len(prompt)
+            article = prompt[marker.end():end].split("\n--- Annotations ---\n")[0].strip()
+            if marker.group(1):
+                blocks.append(f"=== Annotations for article {marker.group(1)} ===")
+            sentences = [s.strip() for s in re.split(r'(?<=[.!?])\s+', article) if s.strip()]
+            for sentence in sentences[:self.annotations_per_article]:
+                blocks.append(f"Label: {self.random.choice(LABELS)}\nText: \"{sentence}\"\n")
+        return "\n".join(blocks)
+
+    async def respond(self, contents, config=None):
+        latency = self._latency()
+        await asyncio.sleep(latency)
+        return self._response(contents, config, latency)
+
+    async def respond_stream(self, contents, config=None):
+        latency = self._latency()
+        await asyncio.sleep(latency / 5)
+        response = self._response(contents, config, latency)
+        chunks = [response.text[k:k + self.chunk_chars] for k in range(0, len(response.text), self.chunk_chars)] or [""]
+        for k, chunk in enumerate(chunks):
+            if k > 0:
+                await asyncio.sleep(latency * 4 / 5 / (len(chunks) - 1))
+            last = k == len(chunks) - 1
+            yield SimpleNamespace(text=chunk, usage_metadata=response.usage_metadata if last else None)
+
+    def _response(self, contents, config, latency):
+        self.stats['calls'] += 1
+        self.latencies.append(latency)
+        draw = self.random.random()
+        if draw < self.quota_error_rate:
+            self.stats['quota_errors'] += 1
+            raise FakeQuotaError("429 RESOURCE_EXHAUSTED (fake)")
+        if draw < self.quota_error_rate + self.error_rate:
+            self.stats['errors'] += 1
+            raise FakeServerError("500 INTERNAL (fake)")
+        prompt = self._prompt_text(contents, config)
+        text = next(self.canned_responses) if self.canned_responses else self.synthesise(prompt)
+        prompt_tokens = estimate_tokens(prompt)
+        output_tokens = estimate_tokens(text)
+        usage = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens,
+            cached_content_token_count=None,
+        )
+        return SimpleNamespace(text=text, usage_metadata=usage)
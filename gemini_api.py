@@ -1,123 +1,191 @@
 import os
 
 import nest_asyncio
-import pandas as pd
-
-nest_asyncio.apply()
-
-from google import genai
-from rapidfuzz import fuzz
 
 GOOGLE_API_KEY = ""
 
 import asyncio
 import json
+import time
 from tqdm import tqdm
-from aiolimiter import AsyncLimiter
-
-
-api_rate_limiter = AsyncLimiter(max_rate=10, time_period=1)
+from rate_limiter import AdaptiveRateLimiter
+from token_utils import estimate_tokens
+from batching import MissingAnnotations, build_batch_prompt, pack_documents, split_batched_response
+from segmentation import merge_segment_annotations, split_long_documents
+from span_alignment import ArticleAligner, MIN_SIMILARITY_THRESHOLD
+from annotation_stream import AnnotationStreamParser, MAX_OFF_FORMAT_LINES, parse_annotation_pairs
+from prefix_cache import create_prefix_cache
+from checkpoint import Checkpoint
+from response_cache import ResponseCache
+from dead_letter import DeadLetterQueue, RequestFailed, failed_articles
+from output_writer import OutputWriter
+from exemplar_cache import load_compiled
+from triage import Triage
+from request_metrics import RequestMetrics, new_record, record_usage
+
+
+# Set these to the quota of your API tier
+REQUESTS_PER_MINUTE = 600
+TOKENS_PER_MINUTE = 2000000
+
+api_rate_limiter = AdaptiveRateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
 
 MAX_RETRIES = 3
 
-
-def create_spanned_annotations_json(article_text, annotations_str):
+# Maximum number of requests in flight at any time
+MAX_IN_FLIGHT = 10
+
+MODEL_NAME = 'gemini-2.5-pro'
+
+# Stream responses and align every annotation as soon as it arrives. Responses that go off-format
+# are cancelled after MAX_OFF_FORMAT_LINES lines instead of being generated in full.
+STREAM_RESPONSES = True
+
+# Skip articles whose id is already in the output file, so a crashed run can simply be restarted
+RESUME = True
+
+# Responses are stored here keyed on model and full prompt, so identical prompts are never paid twice.
+# Set to None to always call the API.
+RESPONSE_CACHE_PATH = "cache/gemini_responses.sqlite"
+
+# Also write every span to a Parquet dataset next to each output JSONL (needs pyarrow)
+COLUMNAR_OUTPUT = False
+
+# Articles whose request still fails after MAX_RETRIES are appended here; replay them with replay.py
+DEAD_LETTER_PATH = "results/failed_requests.jsonl"
+
+# Queue, limiter and API timings, tokens, retries and alignment counts of every request are appended
+# here (None only prints the end-of-run summary); set PROMETHEUS_PATH to also keep a Prometheus
+# text-format file of the totals, e.g. for the node_exporter textfile collector
+METRICS_PATH = "results/request_metrics.jsonl"
+PROMETHEUS_PATH = None
+
+# Where the shared instruction prefix is cached: "gemini" (server side context cache),
+# "local" (in-process stand-in for offline runs) or None to send the full prompt every time
+PREFIX_CACHE_BACKEND = "gemini"
+
+# Short articles are packed into one prompt up to this many article tokens (None sends every article alone)
+BATCH_TOKEN_BUDGET = None
+MAX_ARTICLES_PER_BATCH = 10
+
+# Articles longer than this many tokens are split into overlapping segments that are annotated
+# concurrently, so long responses are not truncated (None sends every article whole)
+MAX_ARTICLE_TOKENS = 6000
+SEGMENT_OVERLAP_TOKENS = 200
+
+# Skip articles that are too short, mostly digits or never mention children before paying for a
+# request (see triage.py); every decision is logged to triage.TRIAGE_LOG_PATH
+TRIAGE = False
+
+# Annotate only one article of every group of near-duplicates (reprints of the same story, see
+# near_duplicates.py); the others get its annotations aligned with their own text
+DEDUPLICATE = True
+
+# Choose the worked examples of every article from all annotated examples by TF-IDF similarity, at
+# most EXAMPLES_PER_ARTICLE of them within EXAMPLE_TOKEN_BUDGET tokens, instead of sending the same
+# first five with every article. The examples then travel with each request, and only the tag
+# descriptions stay in the cached instruction prefix.
+DYNAMIC_EXAMPLES = False
+EXAMPLES_PER_ARTICLE = 3
+EXAMPLE_TOKEN_BUDGET = 3000
+
+# Separator and article text column of the corpus CSVs
+CORPUS_FORMATS = {
+    "french": (',', 'article_text'),
+    "chinese": (',', 'text'),
+}
+DEFAULT_CORPUS_FORMAT = (';', 'fulltext')
+
+LANGUAGES = {
+    "english": {
+        "input_json": "data/annotated_data/en/exportedproject8445656513168862557.json",
+        "path_articles": "data/annotated_data/en/annotation",
+        "output_path": "results/articles_en_corpus_annotated.jsonl",
+        "corpus_path": "data/test_data/en/Child_Labor_2025-09-10_Corp.csv"
+    },
+    "french": {
+        "input_json": "data/annotated_data/fr/exportedproject8149120778901053903.json",
+        "path_articles": "data/annotated_data/fr/annotation",
+        "output_path": "results/articles_fr_corpus_annotated.jsonl",
+        "corpus_path": "data/test_data/fr/Travail_enfants_2025-09-10_Corp.csv"
+    },
+    "chinese": {
+        "input_json": "data/annotated_data/ch/exportedproject4384858266144915893.json",
+        "path_articles": "data/annotated_data/ch/annotation",
+        "output_path": "results/articles_ch_corpus_annotated.jsonl",
+        "corpus_path": "data/test_data/ch/Tonggong_2025-09-10_Corp.csv"
+    }
+}
+
+
+def create_spanned_annotations(article_text, annotations_str, metrics=None):
+    start = time.perf_counter()
+    aligner = ArticleAligner(article_text)
+    pairs = parse_annotation_pairs(annotations_str)
+    for label, text in pairs:
+        aligner.add(text)
+    annotations = aligned_annotations(aligner, [label for label, text in pairs], metrics)
+    if metrics is not None:
+        metrics['alignment_seconds'] += time.perf_counter() - start
+    return annotations
+
+
+def project_annotations(article_text, annotations, metrics=None):
+    """Align the annotations of a near-duplicate article with this article's text."""
+    start = time.perf_counter()
+    aligner = ArticleAligner(article_text)
+    for annotation in annotations:
+        aligner.add(annotation["Text"])
+    annotations = aligned_annotations(aligner, [annotation["Label"] for annotation in annotations], metrics)
+    if metrics is not None:
+        metrics['alignment_seconds'] += time.perf_counter() - start
+    return annotations
+
+
+def aligned_annotations(aligner, labels, metrics=None):
+    """
+    Annotations with spans for the snippets added to the aligner, one label per snippet.
+    The numbers of aligned, fuzzy matched and unmatched snippets are added to metrics if given.
+    """
     annotations = []
-    # Split the annotation string into lines and remove any leading/trailing whitespace
-    lines = [line.strip() for line in annotations_str.strip().split('\n')]
-
-    # A variable to ensure we don't find the same text snippet twice.
-    # We will always search from the end of the last found span.
-    search_from_index = 0
-
-    # Iterate through the lines two at a time (one for Label, one for Text)
-    for i in range(0, len(lines), 2):
-        # Ensure we have a valid pair of Label and Text lines
-        if i + 1 < len(lines) and lines[i].startswith("Label:") and lines[i + 1].startswith("Text:"):
-
-            # Extract the label and the text content
-            label = lines[i].replace("Label:", "").strip()
-            text = lines[i + 1].replace("Text:", "").strip()
-
-            # Remove potential surrounding quotes from the text to search for
-            if text.startswith('"') and text.endswith('"'):
-                text = text[1:-1]
-
-            # Find the start position of the text in the article
-            # Begin the search from the end of the last match
-            start_pos = article_text.find(text, search_from_index)
-
-            if start_pos != -1:
-                end_pos = start_pos + len(text)
-
-                annotations.append({
-                    "Label": label,
-                    "Text": text,
-                    "Span": [start_pos, end_pos]
-                })
-
-                # Update the search position for the next iteration
-                search_from_index = end_pos
-            else:
-                # --- CORRECTED FUZZY MATCHING LOGIC ---
-                # If no exact match, search for the best fuzzy match.
-
-                # --- Configuration ---
-                MIN_SIMILARITY_THRESHOLD = 80  # Adjusted threshold for potentially difficult matches
-
-                # Search the rest of the article from the last known point
-                search_area = article_text[search_from_index:]
-
-                if not search_area: continue  # Skip if there's nothing left to search
-
-                try:
-                    # This function returns a ScoreAlignment object with indices of the best match
-                    alignment = fuzz.partial_ratio_alignment(
-                        text,
-                        search_area,
-                        score_cutoff=MIN_SIMILARITY_THRESHOLD
-                    )
-
-                    if alignment:
-                        # **THE FIX IS HERE:** Reconstruct the matched text using the returned indices
-                        match_start_relative = alignment.dest_start
-                        match_end_relative = alignment.dest_end
-                        best_match_text = search_area[match_start_relative:match_end_relative]
-
-                        # Convert relative indices to absolute positions in the full article
-                        best_start_pos = search_from_index + match_start_relative
-                        best_end_pos = search_from_index + match_end_relative
-
-                        # Inform the user about the correction
-                        print(f"--- Fuzzy Match Found (Corrected) ---")
-                        print(f"  Label: {label}")
-                        print(f"  Original Text: '{text}'")
-                        print(f"  Matched Text:  '{best_match_text}' (Score: {alignment.score:.1f}%)")
-                        print(f"-------------------------------------\n")
-
-                        annotations.append({
-                            "Label": label,
-                            "Text": best_match_text,  # Use the corrected text from the article
-                            "Span": [best_start_pos, best_end_pos]
-                        })
-                        search_from_index = best_end_pos
-                    else:
-                        print(
-                            f"Warning: Could not find a suitable match for the following text (Score < {MIN_SIMILARITY_THRESHOLD}%):\n'{text}'\n")
-
-                except Exception as e:
-                    print(f"An error occurred during fuzzy search for '{text}': {e}")
-                except Exception as e:
-                    print(f"An error occurred during fuzzy search for '{text}': {e}")
-
-    # Convert the list of dictionaries into a nicely formatted JSON string
-    return json.dumps(annotations)
+    article_text = aligner.article_text
+    # Exact matches are found first and bound the windows in which the remaining snippets are fuzzy matched
+    try:
+        matches = aligner.finish()
+    except Exception as e:
+        print(f"An error occurred during fuzzy search: {e}")
+        return annotations
+
+    for label, text, match in zip(labels, aligner.texts, matches):
+        if metrics is not None:
+            metrics['aligned'] += match is not None
+            metrics['fuzzy_matches'] += match is not None and match[2] is not None
+            metrics['unmatched'] += match is None
+        if match is None:
+            print(
+                f"Warning: Could not find a suitable match for the following text (Score < {MIN_SIMILARITY_THRESHOLD}%):\n'{text}'\n")
+            continue
 
+        start_pos, end_pos, score = match
+        matched_text = article_text[start_pos:end_pos]
+        if score is not None:
+            # Inform the user about the correction
+            print(f"--- Fuzzy Match Found (Corrected) ---")
+            print(f"  Label: {label}")
+            print(f"  Original Text: '{text}'")
+            print(f"  Matched Text:  '{matched_text}' (Score: {score:.1f}%)")
+            print(f"-------------------------------------\n")
 
+        annotations.append({
+            "Label": label,
+            "Text": matched_text,  # For fuzzy matches, use the corrected text from the article
+            "Span": [start_pos, end_pos]
+        })
 
+    return annotations
 
 
-def get_labels(input_json):
+def read_tag_set(input_json):
     prompt = ""
     with open(input_json, "r", encoding='utf-8') as f:
         data = json.load(f)
@@ -127,195 +195,596 @@ def get_labels(input_json):
     return prompt
 
 
+def get_labels(input_json):
+    # The INCEpTION export is large, so the tag descriptions are only read from it again when it changes
+    return load_compiled('labels:' + input_json, [input_json], lambda: read_tag_set(input_json))
+
+
+def example_files(path):
+    """The annotator JSON files under the annotation directory, grouped per annotated article."""
+    groups = []
+    for f in os.listdir(path):
+        group = []
+        for sub_f in os.listdir(os.path.join(path, f)):
+            dir2 = os.path.join(path, f, sub_f)
+            for sub_sub_f in os.listdir(dir2):
+                if sub_sub_f.endswith('.json'):
+                    group.append(os.path.join(dir2, sub_sub_f))
+        groups.append(group)
+    return groups
+
+
+def read_example(input_json):
+    """The article text of an annotator file and its (label, snippet) annotations."""
+    with open(input_json, "r", encoding='utf-8') as jf:
+        data = json.load(jf)
+    annotations = data['_views']["_InitialView"]['Chunk']
+    full_text = data['_referenced_fss']['1']['sofaString']
+    pairs = []
+    for anno in annotations:
+        try:
+            begin_index = anno['begin']
+        except:
+            begin_index = 0
+        end_index = anno['end']
+        if 'chunkValue' in anno:
+            label = anno['chunkValue']
+        else:
+            label = "unknown label"
+
+        # Extract the text snippet using the begin/end indices
+        snippet = full_text[begin_index:end_index]
+        pairs.append([label, snippet])
+    return {'text': full_text, 'annotations': pairs}
+
+
+def compile_examples(path):
+    """
+    Every worked example under the annotation directory, as a list per annotated article of
+    {'text', 'annotations'} dicts, loaded from the exemplar cache unless an annotator file changed.
+    """
+    groups = example_files(path)
+    sources = [input_json for group in groups for input_json in group]
+    return load_compiled('examples:' + path, sources, lambda: [[read_example(input_json) for input_json in group]
+                                                                for group in groups])
+
+
+def format_example(example):
+    article_prompt = ""
+    article_prompt += "\n--- News article ---\n"
+    article_prompt += example['text']
+    article_prompt += "\n--- Annotations ---\n"
+    for label, snippet in example['annotations']:
+        article_prompt += f"Label: {label}\n"
+        article_prompt += f"Text: \"{snippet}\"\n\n"
+    return article_prompt
+
+
 def get_examples(path, n=5):
-    files = os.listdir(path)
-    counter = 0
     article_prompts = []
-    for f in files:
-        dir = os.listdir(os.path.join(path, f))
-        counter += 1
-        if counter <= n:
-            for sub_f in dir:
-                dir2 = os.path.join(path, f, sub_f)
-                files2 = os.listdir(dir2)
-                for sub_sub_f in files2:
-                    if sub_sub_f.endswith('.json'):
-                        #print(f)
-                        input_json = os.path.join(dir2, sub_sub_f)
-                        with open(input_json, "r", encoding='utf-8') as jf:
-                            article_prompt = ""
-                            data = json.load(jf)
-                            data.pop("_context")
-                            data['_views'][ "_InitialView"].pop("FeatureDefinition" )
-                            data['_views']["_InitialView"].pop("LayerDefinition")
-                            data['_views']["_InitialView"].pop("DocumentMetaData")
-                            data['_views']["_InitialView"].pop("TagsetDescription")
-
-                            article_prompt += "\n--- News article ---\n"
-                            annotations = data['_views']["_InitialView"]['Chunk']
-                            full_text = data['_referenced_fss']['1']['sofaString']
-                            article_prompt += full_text
-                            article_prompt += "\n--- Annotations ---\n"
-                            for anno in annotations:
-                                try:
-                                    begin_index = anno['begin']
-                                except:
-                                    begin_index = 0
-                                end_index = anno['end']
-                                if 'chunkValue' in anno:
-                                    label = anno['chunkValue']
-                                else:
-                                    label = "unknown label"
-
-                                # Extract the text snippet using the begin/end indices
-                                snippet = full_text[begin_index:end_index]
-
-                                article_prompt += f"Label: {label}\n"
-                                article_prompt += f"Text: \"{snippet}\"\n\n"
-                                #print(f"Position: (Characters {begin_index}:{end_index})\n")
-                            article_prompts.append(article_prompt)
+    for group in compile_examples(path)[:n]:
+        for example in group:
+            article_prompts.append(format_example(example))
     return "\n".join(article_prompts)
 
 
-def get_articles_from_corpus(path, language):
-    if language == "french":
-        df = pd.read_csv(path, encoding='utf8', sep=',')
-        df = df.astype(str)
-        article_texts = df['article_text'].tolist()
-        article_names = df['date'] + "---" + df['id'].tolist()
-    elif language == "chinese":
-        df = pd.read_csv(path, encoding='utf8', sep=',')
-        df = df.astype(str)
-        article_texts = df['text'].tolist()
-        article_names = (df['date'] + "---" + df['id']).tolist()
-    else:
-        df = pd.read_csv(path, encoding='utf8', sep=';')
-        df = df.astype(str)
-        article_texts = df['fulltext'].tolist()
-        article_names = (df['date'] + "---" + df['id']).tolist()
+def exemplar_index(language_config):
+    """TF-IDF index over every annotated example of a language, one entry per annotated article."""
+    from exemplar_retrieval import ExemplarIndex
 
-    return article_texts, article_names
+    exemplars = [(group[0]['text'], "\n".join(format_example(example) for example in group))
+                 for group in compile_examples(language_config["path_articles"]) if group]
+    return ExemplarIndex(exemplars, EXAMPLES_PER_ARTICLE, EXAMPLE_TOKEN_BUDGET)
 
 
-async def process_document(i, document, delay=1):
+def iter_articles_from_corpus(path, language, chunksize=1000):
+    """
+    Yield (id, article) pairs from a corpus CSV, reading chunksize rows at a time,
+    so memory use does not grow with the size of the corpus.
     """
-    Process a single document: wait for a given delay, then send the prompt to the Gemini model,
-    enforcing the API rate limit with a limiter.
+    import pandas as pd
 
-    After receiving the response, the function attempts to clean and evaluate the text.
-    If that fails, it retries the LLM call up to MAX_RETRIES times.
+    sep, text_column = CORPUS_FORMATS.get(language, DEFAULT_CORPUS_FORMAT)
+    chunks = pd.read_csv(path, encoding='utf8', sep=sep, usecols=['date', 'id', text_column], chunksize=chunksize,
+                         dtype=str, keep_default_na=False)
+    for df in chunks:
+        yield from zip(df['date'] + "---" + df['id'], df[text_column])
+
+
+def get_articles_from_corpus(path, language):
+    article_texts = []
+    article_names = []
+    for id, art in iter_articles_from_corpus(path, language):
+        article_names.append(id)
+        article_texts.append(art)
+    return article_texts, article_names
+
+
+def get_instructions(language_config, n=5, packed=False):
+    """
+    The instruction prefix shared by every article of a language: tag descriptions and n worked examples.
+    With n=0 it ends where the examples would start, for examples chosen per article (see DYNAMIC_EXAMPLES).
+    With packed=True it ends after the examples, as packed prompts close with BATCH_INSTRUCTIONS instead.
+    """
+    prompt1 = "You are a history expert specializing in the study of child labor. Your task is to annotate passages in historical newspaper articles that discuss child labor. You will tag segments of the text according to the specific aspect of the discourse they represent.\n"
+    prompt1 += "Below is a list of tags with descriptions of what each tag covers. Use these tags to annotate the provided text.\n\nAnnotation Tags and Descriptions:\n\n"
+    prompt1 += get_labels(language_config["input_json"])
+    prompt2 = "Here are examples of news articles annotated according to the tags defined above:\n"
+    examples = get_examples(language_config["path_articles"], n=n)
+    prompt2 += examples
+    instructions = prompt1 + prompt2
+    if n == 0 or packed:
+        return instructions
+    instructions += "Please annotate the news article below in the same manner as in the example above. Return only annotations and nothing else. Do not change the extracted text in any way.\n"
+    return instructions
+
+
+def iter_documents(articles, instructions, prefix_name=None, checkpoint=None, output_path=None):
+    """
+    Yield request documents for the (id, article) pairs that are not yet completed in the checkpoint.
+    The prompt itself is only built by build_prompt when the request is sent. When the instructions
+    are served from the prefix cache (prefix_name is set), it only holds the article. output_path is
+    stored on the documents when several corpora are processed in one run. 'read_at' is the
+    time.monotonic() the article was read, from which the queue wait of its request is measured.
+    """
+    if checkpoint is not None:
+        print("Already annotated:", len(checkpoint.completed))
+    for id, art in articles:
+        if checkpoint is not None and checkpoint.is_done(id):
+            continue
+        #art = " ".join(art.split())
+        doc = {'id': id, 'article': art, 'prefix_name': prefix_name,
+               'instructions': instructions if prefix_name is None else None, 'read_at': time.monotonic()}
+        if output_path is not None:
+            doc['output_path'] = output_path
+        yield doc
+
+
+# Follows the examples chosen for an article (with DYNAMIC_EXAMPLES), and the shared examples of an
+# article that is sent alone when articles are packed
+ARTICLE_INSTRUCTIONS = "Please annotate the news article below in the same manner as in the examples above. Return only annotations and nothing else. Do not change the extracted text in any way.\n"
+
+
+def build_prompt(document):
+    """The prompt of a document; see build_batch_prompt for packed documents."""
+    if 'members' in document:
+        return build_batch_prompt(document['batch_prefix'], document['members'], document.get('examples', []))
+    whole_prompt = document['instructions'] or ""
+    if 'examples' in document or document.get('alone'):
+        whole_prompt += "\n".join(document.get('examples', []))
+        whole_prompt += ARTICLE_INSTRUCTIONS
+    whole_prompt += "\n--- News article ---\n"
+    whole_prompt += document['article']
+    whole_prompt += "\n--- Annotations ---\n"
+    return whole_prompt
+
+
+def create_client(api_key=GOOGLE_API_KEY):
     """
+    Create the one Gemini client shared by every request of a run, so HTTP connections
+    are pooled and reused instead of opening a new client per document.
+    """
+    from google import genai
+    from google.genai import types
+    import httpx
+
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            async_client_args={
+                'limits': httpx.Limits(max_connections=MAX_IN_FLIGHT, max_keepalive_connections=MAX_IN_FLIGHT)
+            }
+        )
+    )
 
-    client = genai.Client(api_key=GOOGLE_API_KEY)
 
-    prompt = document['prompt']
+async def stream_annotations(document, client, contents, config, metrics=None):
+    """
+    Generate the response as a stream and align every Label:/Text: pair with the article while
+    the rest is still being generated. Returns the response text, its usage metadata and the
+    aligned annotations. Raises OffFormatResponse, after closing the stream, when the response
+    does not follow the annotation format. The time spent aligning is added to metrics if given.
+    """
+    parser = AnnotationStreamParser(MAX_OFF_FORMAT_LINES)
+    aligner = ArticleAligner(document['article'])
+    labels = []
+    chunks = []
+    usage_metadata = None
+    aligning = 0.0
+    stream = await client.aio.models.generate_content_stream(model=MODEL_NAME, contents=contents, config=config)
+    try:
+        async for chunk in stream:
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            if not chunk.text:
+                continue
+            chunks.append(chunk.text)
+            start = time.perf_counter()
+            for label, text in parser.feed(chunk.text):
+                labels.append(label)
+                aligner.add(text)
+            aligning += time.perf_counter() - start
+        start = time.perf_counter()
+        for label, text in parser.close():
+            labels.append(label)
+            aligner.add(text)
+        annotations = aligned_annotations(aligner, labels, metrics)
+        aligning += time.perf_counter() - start
+    finally:
+        if hasattr(stream, 'aclose'):
+            await stream.aclose()
+        if metrics is not None:
+            metrics['alignment_seconds'] += aligning
+    return "".join(chunks), usage_metadata, annotations
+
+
+async def process_document(i, document, client, prefix_cache=None, response_cache=None):
+    """
+    Process a single document: wait until the rate limiter has budget for the estimated prompt
+    tokens, then send the prompt to the Gemini model.
+    If a prefix cache is given, the document prompt only holds the article part and the
+    instruction prefix is referenced through the cache.
+    If a response cache is given, a stored response for the same model and prompt is used
+    instead of calling the API.
+    With STREAM_RESPONSES, single articles are annotated from the streamed response and the
+    aligned annotations are returned on a copy of the document.
+
+    If the call fails, it is retried up to MAX_RETRIES times with exponential backoff and jitter.
+    Quota errors additionally slow down the shared rate limiter. If the last attempt fails too,
+    RequestFailed is raised with the document, the last error and the number of attempts.
+    Near-duplicates of an article that is already annotated are returned without a request.
+
+    The returned document (and the document of RequestFailed) carries the request's metrics record
+    under 'metrics' (see request_metrics).
+    """
+    metrics = new_record(document)
+    if 'duplicate_of' in document:
+        return i, None, dict(document, metrics=dict(metrics, source='duplicate'))
+
+    prompt = build_prompt(document)
+    if prefix_cache is not None:
+        await prefix_cache.refresh(document['prefix_name'])
+        contents, config = prefix_cache.build_request(document['prefix_name'], prompt)
+        full_prompt = prefix_cache.full_prompt(document['prefix_name'], prompt)
+    else:
+        contents, config = [prompt], None
+        full_prompt = prompt
 
+    if response_cache is not None:
+        cache_key = response_cache.key(MODEL_NAME, full_prompt)
+        text = response_cache.get(cache_key)
+        if text is not None:
+            return i, text, dict(document, metrics=dict(metrics, source='response_cache'))
 
+    estimated_tokens = estimate_tokens(full_prompt)
+    metrics['estimated_tokens'] = estimated_tokens
     attempt = 0
     while attempt < MAX_RETRIES:
         try:
-            await asyncio.sleep(delay)
-            async with api_rate_limiter:
-                result = await client.aio.models.generate_content(
-                    model='gemini-2.5-pro',
-                    contents=[
-                        prompt,
-                    ]
-                )
-            text = result.text
-            return i, text, document
+            metrics['attempts'] += 1
+            start = time.monotonic()
+            await api_rate_limiter.acquire(estimated_tokens)
+            metrics['limiter_wait'] += time.monotonic() - start
+            start = time.monotonic()
+            aligning = metrics['alignment_seconds']
+            try:
+                if STREAM_RESPONSES and 'members' not in document:
+                    text, usage_metadata, annotations = await stream_annotations(
+                        document, client, contents, config, metrics
+                    )
+                    document = dict(document, annotations=annotations)
+                else:
+                    result = await client.aio.models.generate_content(
+                        model=MODEL_NAME,
+                        contents=contents,
+                        config=config
+                    )
+                    text, usage_metadata = result.text, result.usage_metadata
+            finally:
+                # Aligning while the response streams in is counted as alignment, not as API time
+                metrics['api_latency'] += time.monotonic() - start - (metrics['alignment_seconds'] - aligning)
+            record_usage(metrics, usage_metadata)
+            api_rate_limiter.success(estimated_tokens, getattr(usage_metadata, 'total_token_count', None))
+            if prefix_cache is not None:
+                prefix_cache.record_usage(document['prefix_name'], usage_metadata)
+            # A packed response that lost the annotations of an article is not stored, so the article
+            # is not stuck with it when a resumed run builds the same prompt again
+            if response_cache is not None and text and (
+                    'members' not in document or None not in split_batched_response(text, len(document['members']))):
+                response_cache.put(cache_key, MODEL_NAME, text)
+            return i, text, dict(document, metrics=metrics)
 
         except Exception as e:
             attempt += 1
+            metrics['errors'].append(type(e).__name__)
             if attempt >= MAX_RETRIES:
-                return i, f"Error after {MAX_RETRIES} retries: {e}"
+                raise RequestFailed(dict(document, metrics=metrics), e, attempt)
+            metrics['retries'] += 1
+            if api_rate_limiter.is_quota_error(e):
+                api_rate_limiter.throttle(attempt)
+            else:
+                await asyncio.sleep(api_rate_limiter.backoff(attempt))
 
 
-async def process_grouped_documents(documents_grouped, output_path, current_chunk):
+def build_example(document, output_text, metrics=None):
+    """
+    Align the generated annotations of one article with its text and return the resulting
+    example, with the annotations as a list of {"Label", "Text", "Span"} objects.
+    For a segment of a split article, None is returned until all its segments are in.
+    """
+    if 'parent' in document:
+        return add_segment(document, output_text, metrics)
+    if 'duplicate_of' in document:
+        document['duplicate_of'].stats['projected'] += 1
+        return make_example(document, project_annotations(
+            document['article'], document['duplicate_of'].annotations, metrics
+        ))
+    annotations = document.get('annotations')
+    if annotations is None:
+        annotations = create_spanned_annotations(document['article'], output_text, metrics)
+    return make_example(document, annotations)
+
+
+def add_segment(document, output_text, metrics=None):
+    """
+    Align the annotations of one segment of a split article and shift their spans by the offset of
+    the segment. Returns the example of the article once the annotations of all its segments are in.
+    """
+    parent = document['parent']
+    annotations = document.get('annotations')
+    if annotations is None:
+        annotations = create_spanned_annotations(document['article'], output_text, metrics)
+    for annotation in annotations:
+        start, end = annotation["Span"]
+        annotation["Span"] = [start + document['offset'], end + document['offset']]
+        parent['segment_annotations'].append(annotation)
+    parent['pending_segments'] -= 1
+    if parent['pending_segments'] == 0:
+        return make_example(parent, merge_segment_annotations(parent['segment_annotations']))
+    return None
+
+
+def make_example(document, annotations):
+    example = {}
+    example["id"] = document['id']
+    example["article"] = document['article']
+    example["annotations"] = annotations
+    return example
+
+
+def build_examples(all_output):
     """
-    Processes all documents in parallel by creating tasks for each document.
-    documents_grouped is a list of tuples (original_index, document).
-    Uses asyncio.as_completed to yield tasks as they finish, updating a progress bar.
-    Returns a dictionary mapping the original document indices to their generated text.
+    The examples produced by one finished request, and the members of a packed prompt that are
+    missing from its response. Responses to packed prompts are first split back into the
+    annotations of each article. The alignment counts go into the request's metrics.
     """
+    i, output_text, document = all_output
+    metrics = document.get('metrics')
+    if 'members' not in document:
+        return with_duplicates(document, build_example(document, output_text, metrics), metrics), []
+    examples = []
+    missing = []
+    parts = split_batched_response(output_text, len(document['members']))
+    for member, member_text in zip(document['members'], parts):
+        if member_text is None:
+            print(f"Warning: no annotations for article '{member['id']}' in the packed response")
+            missing.append(member)
+            continue
+        examples.extend(with_duplicates(member, build_example(member, member_text, metrics), metrics))
+    return examples, missing
 
-    tasks = [
-        asyncio.create_task(process_document(i, document))
-        for i, document in documents_grouped
-    ]
-    output_file = open(output_path, 'a', encoding='utf-8')
 
-    for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Processing Documents"):
-        try:
-            all_output = await future
-            if len(all_output) == 3:
-                i, output_text, document = all_output
-            else:
-                print('Error with output: ')
-                print(all_output)
-                continue
-            example = {}
-            example["id"] = document['id']
-            example["article"] = document['article']
-            processed_annotations = create_spanned_annotations_json(document['article'], output_text)
-            example["annotations"] = processed_annotations
-            json_line = json.dumps(example, ensure_ascii=False)  # Convert dictionary to a JSON string
-            output_file.write(json_line + '\n')
-        except Exception as e:
-            print('Error in generation:')
-            print(e)
-            continue
-    output_file.close()
+def with_duplicates(document, example, metrics=None):
+    """
+    The example of a document (none while segments are pending), followed by the examples of the
+    near-duplicates that waited for it, with its annotations aligned with their text.
+    """
+    if example is None:
+        return []
+    cluster = document.get('parent', document).get('cluster')
+    if cluster is None:
+        return [example]
+    return [example] + [build_example(duplicate, None, metrics) for duplicate in cluster.resolve(example["annotations"])]
 
 
-if __name__ == '__main__':
+async def process_grouped_documents(documents_grouped, output_path, client, prefix_cache=None, total=None,
+                                    checkpoints=None, response_cache=None, dead_letters=None,
+                                    columnar=COLUMNAR_OUTPUT, metrics=None):
+    """
+    Streams all documents through a sliding window of at most MAX_IN_FLIGHT concurrent requests.
+    documents_grouped is an iterable of tuples (original_index, document).
+    A new request is started as soon as any running one finishes, so a single slow call
+    never holds up the rest, and every result is handed to the OutputWriter as soon as it arrives.
+    Documents with their own 'output_path' are written there instead of to output_path, and
+    checkpoints maps output paths to the Checkpoint recording their completed ids.
+    Requests that fail for good are recorded in the dead_letters queue when one is given.
+    If the OutputWriter fails, no new requests are started, the results of the running ones are
+    dead-lettered, and its error is raised once they are done.
+    The metrics record of every finished request is handed to metrics (a RequestMetrics) when given.
+    """
 
-    languages = {
-        "english": {
-            "input_json": "data/annotated_data/en/exportedproject8445656513168862557.json",
-            "path_articles": "data/annotated_data/en/annotation",
-            "output_path": "results/articles_en_corpus_annotated.jsonl",
-            "corpus_path": "data/test_data/en/Child_Labor_2025-09-10_Corp.csv"
-        },
-        "french": {
-            "input_json": "data/annotated_data/fr/exportedproject8149120778901053903.json",
-            "path_articles": "data/annotated_data/fr/annotation",
-            "output_path": "results/articles_fr_corpus_annotated.jsonl",
-            "corpus_path": "data/test_data/fr/Travail_enfants_2025-09-10_Corp.csv"
-        },
-        "chinese": {
-            "input_json": "data/annotated_data/ch/exportedproject4384858266144915893.json",
-            "path_articles": "data/annotated_data/ch/annotation",
-            "output_path": "results/articles_ch_corpus_annotated.jsonl",
-            "corpus_path": "data/test_data/ch/Tonggong_2025-09-10_Corp.csv"
-        }
+    documents_grouped = iter(documents_grouped)
+    # Running requests and their documents
+    pending = {}
+
+    def fill_window():
+        while len(pending) < MAX_IN_FLIGHT:
+            item = next(documents_grouped, None)
+            if item is None:
+                break
+            i, document = item
+            pending[asyncio.create_task(process_document(
+                i, document, client, prefix_cache=prefix_cache, response_cache=response_cache
+            ))] = document
+
+    def lose(document, path, error, attempts):
+        """
+        Record the articles of a document that will not be written, and fail the near-duplicate
+        clusters they represent, so the reprints waiting for them are dead-lettered as well.
+        """
+        if dead_letters is not None:
+            dead_letters.add(document, path, error, attempts)
+            return
+        for article in failed_articles(document):
+            print(f"Article '{article['id']}' was not annotated")
+
+    # Not `checkpoints or {}`: replay.py fills its (initially empty) dict while the requests are read
+    if checkpoints is None:
+        checkpoints = {}
+    writer = OutputWriter(checkpoints, columnar=columnar)
+    writer.start()
+    progress = tqdm(total=total, desc="Processing Documents")
+
+    writer_failed = False
+    fill_window()
+    while pending:
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        documents = {future: pending.pop(future) for future in done}
+        if writer.failed:
+            if not writer_failed:
+                writer_failed = True
+                print(f"Output writer failed, no new requests are started: {writer.task.exception()!r}")
+        else:
+            fill_window()
+        for future in done:
+            try:
+                all_output = future.result()
+                path = all_output[2].get('output_path', output_path)
+                examples, missing = build_examples(all_output)
+                for example in examples:
+                    await writer.put(path, example)
+                if missing:
+                    # Not written, so they can be replayed (or are picked up again by a resumed run)
+                    lose(dict(all_output[2], members=missing), path,
+                         MissingAnnotations("No annotations for the article in the packed response"),
+                         all_output[2]['metrics']['attempts'])
+                if metrics is not None and 'metrics' in all_output[2]:
+                    metrics.add(all_output[2]['metrics'], path, articles=len(examples))
+            except RequestFailed as e:
+                print(f"Request '{e.document['id']}' failed: {e}")
+                lose(e.document, output_path, e.error, e.attempts)
+                if metrics is not None and 'metrics' in e.document:
+                    metrics.add(e.document['metrics'], e.document.get('output_path', output_path), failed=True)
+            except Exception as e:
+                print('Error in generation:')
+                print(e)
+                lose(documents[future], output_path, e, 1)
+            progress.update(1)
+    progress.close()
+    try:
+        await writer.close()
+    finally:
+        print(writer.summary())
+        for checkpoint in checkpoints.values():
+            checkpoint.close()
+
+
+def corpus_settings():
+    """The request pipeline settings of the English, French and Chinese corpora (see build_requests)."""
+    return {
+        'resume': RESUME,
+        'triage': TRIAGE,
+        'deduplicate': DEDUPLICATE,
+        'max_article_tokens': MAX_ARTICLE_TOKENS,
+        'segment_overlap_tokens': SEGMENT_OVERLAP_TOKENS,
+        'dynamic_examples': DYNAMIC_EXAMPLES,
+        'exemplar_index': exemplar_index,
+        'batch_token_budget': BATCH_TOKEN_BUDGET,
+        'max_articles_per_batch': MAX_ARTICLES_PER_BATCH,
     }
 
-    for language in languages.keys():
+
+def build_requests(language, config, settings, articles, instructions, prefix_cache, checkpoints, stages):
+    """
+    Lazy stream of the request documents of one corpus: the (id, article) pairs of articles go
+    through triage, near-duplicate detection, splitting of long articles, packing and example
+    selection as enabled in settings (see corpus_settings), and are read only as slots in the
+    in-flight window free up. The instructions are registered with the prefix cache, the Checkpoint
+    of the output file is added to checkpoints (with settings['resume']), and the Triage,
+    Deduplicator and ExemplarIndex of the corpus are added to stages for close_stages.
+    """
+    output_path = config["output_path"]
+    prefix_name = None
+    if prefix_cache is not None:
+        # The instructions are identical for every article, so register them once and only send the article
+        prefix_name = prefix_cache.register(MODEL_NAME, instructions, key=language)
+    checkpoint = None
+    if settings['resume']:
+        checkpoint = Checkpoint(output_path)
+        checkpoints[output_path] = checkpoint
+    requests = iter_documents(articles, instructions, prefix_name, checkpoint, output_path)
+    if settings['triage']:
+        stages.append(Triage(language))
+        requests = stages[-1].filter(requests)
+    if settings['deduplicate']:
+        from near_duplicates import Deduplicator
+        stages.append(Deduplicator(language))
+        requests = stages[-1].filter(requests)
+    if settings['max_article_tokens']:
+        # A split article is only written (and checkpointed) once every segment has been annotated
+        requests = split_long_documents(requests, settings['max_article_tokens'], settings['segment_overlap_tokens'])
+    if settings['batch_token_budget']:
+        requests = pack_documents(requests, instructions if prefix_cache is None else "",
+                                  settings['batch_token_budget'], settings['max_articles_per_batch'])
+    if settings['dynamic_examples']:
+        # After packing, so a packed prompt gets one set of examples within EXAMPLE_TOKEN_BUDGET
+        from exemplar_retrieval import add_examples
+        stages.append(settings['exemplar_index'](config))
+        requests = add_examples(requests, stages[-1])
+    return requests
+
+
+def close_stages(stages):
+    """Print the summaries of the stages of build_requests and close the ones that keep files open."""
+    for stage in stages:
+        print(stage.summary())
+        if hasattr(stage, 'close'):
+            stage.close()
+
+
+def main(languages=None):
+    """Annotate the corpora of the given languages (default: all of LANGUAGES) one after another."""
+    nest_asyncio.apply()
+    client = create_client()
+    prefix_cache = create_prefix_cache(PREFIX_CACHE_BACKEND, client)
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH) if RESPONSE_CACHE_PATH else None
+    dead_letters = DeadLetterQueue(DEAD_LETTER_PATH) if DEAD_LETTER_PATH else None
+    metrics = RequestMetrics(METRICS_PATH, PROMETHEUS_PATH)
+    # One event loop for the whole run, shared by all languages
+    loop = asyncio.new_event_loop()
+
+    for language in languages or LANGUAGES:
+        config = LANGUAGES[language]
 
         print("Processing", language)
-        all_docs = []
-        n = 5
-        prompt1 = "You are a history expert specializing in the study of child labor. Your task is to annotate passages in historical newspaper articles that discuss child labor. You will tag segments of the text according to the specific aspect of the discourse they represent.\n"
-        prompt1 += "Below is a list of tags with descriptions of what each tag covers. Use these tags to annotate the provided text.\n\nAnnotation Tags and Descriptions:\n\n"
-        prompt1 += get_labels(languages[language]["input_json"])
-        prompt2 = "Here are examples of news articles annotated according to the tags defined above:\n"
-        examples = get_examples(languages[language]["path_articles"], n=n)
-        prompt2 += examples
-        instructions = prompt1 + prompt2
-        articles, ids = get_articles_from_corpus(languages[language]["corpus_path"], language)
-        for id, art in zip(ids, articles):
-            #art = " ".join(art.split())
-            whole_prompt = instructions
-            whole_prompt += "Please annotate the news article below in the same manner as in the example above. Return only annotations and nothing else. Do not change the extracted text in any way.\n"
-            whole_prompt += "\n--- News article ---\n"
-            whole_prompt += art
-            whole_prompt += "\n--- Annotations ---\n"
-            doc = {'id': id, 'prompt': whole_prompt, 'article': art}
-            all_docs.append(doc)
-        chunks = 10
-        for i in range(0, len(all_docs), chunks):
-            print("Chunk:", i)
-            asyncio.run(process_grouped_documents(enumerate(all_docs[i:i + chunks]), languages[language]["output_path"], i))
+        instructions = get_instructions(config, n=0 if DYNAMIC_EXAMPLES else 5, packed=bool(BATCH_TOKEN_BUDGET))
+        checkpoints = {}
+        stages = []
+        requests = build_requests(language, config, corpus_settings(),
+                                  iter_articles_from_corpus(config["corpus_path"], language), instructions,
+                                  prefix_cache, checkpoints, stages)
+        loop.run_until_complete(process_grouped_documents(
+            enumerate(requests), config["output_path"], client, prefix_cache, checkpoints=checkpoints,
+            response_cache=response_cache, dead_letters=dead_letters, metrics=metrics
+        ))
+        close_stages(stages)
+        if prefix_cache is not None:
+            print(prefix_cache.summary())
+        if response_cache is not None:
+            print(response_cache.summary())
+        print(api_rate_limiter.summary())
+
+    print(metrics.summary())
+    metrics.close()
+    if dead_letters is not None:
+        print(dead_letters.summary())
+        dead_letters.close()
+    if prefix_cache is not None:
+        prefix_cache.close()
+    if response_cache is not None:
+        response_cache.close()
+    loop.run_until_complete(client.aio.aclose())
+    loop.close()
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import nest_asyncio
+
+import argparse
+import asyncio
+import gemini_api
+import gemini_api_de
+from gemini_api import (DEAD_LETTER_PATH, METRICS_PATH, PREFIX_CACHE_BACKEND, PROMETHEUS_PATH, RESPONSE_CACHE_PATH,
+                        api_rate_limiter, build_requests, close_stages, create_client, process_grouped_documents)
+from request_metrics import RequestMetrics
+from prefix_cache import create_prefix_cache
+from response_cache import ResponseCache
+from dead_letter import DeadLetterQueue
+
+
+# Share of the request slots each language gets while all of them still have work left.
+# A language that runs out of articles leaves its share to the others.
+LANGUAGE_WEIGHTS = {
+    "english": 1,
+    "french": 1,
+    "chinese": 1,
+    "german": 1,
+}
+
+
+def load_language(language, prefix_cache, checkpoints, stages):
+    """
+    Lazy stream of the request documents of one corpus, with their output path set on each document,
+    built with the settings of the script of the corpus (gemini_api_de for German, gemini_api otherwise).
+    Only the instructions are prepared up front; articles are read as the scheduler asks for them.
+    """
+    if language == "german":
+        config = gemini_api_de.GERMAN
+        settings = gemini_api_de.corpus_settings()
+        instructions = gemini_api_de.get_instructions(config, n=0 if settings['dynamic_examples'] else 5,
+                                                      packed=bool(settings['batch_token_budget']))
+        articles = gemini_api_de.iter_articles_from_corpus(config["corpus_path"])
+    else:
+        config = gemini_api.LANGUAGES[language]
+        settings = gemini_api.corpus_settings()
+        instructions = gemini_api.get_instructions(config, n=0 if settings['dynamic_examples'] else 5,
+                                                   packed=bool(settings['batch_token_budget']))
+        articles = gemini_api.iter_articles_from_corpus(config["corpus_path"], language)
+    print("Loading", language)
+    return build_requests(language, config, settings, articles, instructions, prefix_cache, checkpoints, stages)
+
+
+def interleave(queues, weights):
+    """
+    Merge the per-language request streams into one queue by smooth weighted round robin,
+    so every language keeps getting its share of the in-flight window until it runs out.
+    """
+    iterators = {language: iter(requests) for language, requests in queues.items()}
+    current = {language: 0 for language in iterators}
+    while iterators:
+        total = sum(weights.get(language, 1) for language in iterators)
+        for language in iterators:
+            current[language] += weights.get(language, 1)
+        language = max(iterators, key=lambda name: current[name])
+        current[language] -= total
+        request = next(iterators[language], None)
+        if request is None:
+            del iterators[language]
+            del current[language]
+            continue
+        yield request
+
+
+def main(languages=None):
+    """Annotate the corpora of the given languages (default: all of LANGUAGE_WEIGHTS) in one shared run."""
+    nest_asyncio.apply()
+    client = create_client()
+    prefix_cache = create_prefix_cache(PREFIX_CACHE_BACKEND, client)
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH) if RESPONSE_CACHE_PATH else None
+    dead_letters = DeadLetterQueue(DEAD_LETTER_PATH) if DEAD_LETTER_PATH else None
+    metrics = RequestMetrics(METRICS_PATH, PROMETHEUS_PATH)
+    checkpoints = {}
+    stages = []
+
+    queues = {language: load_language(language, prefix_cache, checkpoints, stages) for language in languages or LANGUAGE_WEIGHTS}
+
+    # All languages share one event loop, one in-flight window and one rate limiter budget
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(process_grouped_documents(
+        enumerate(interleave(queues, LANGUAGE_WEIGHTS)), None, client, prefix_cache,
+        checkpoints=checkpoints, response_cache=response_cache, dead_letters=dead_letters, metrics=metrics
+    ))
+
+    close_stages(stages)
+    print(metrics.summary())
+    metrics.close()
+    if dead_letters is not None:
+        print(dead_letters.summary())
+        dead_letters.close()
+    if prefix_cache is not None:
+        print(prefix_cache.summary())
+        prefix_cache.close()
+    if response_cache is not None:
+        print(response_cache.summary())
+        response_cache.close()
+    print(api_rate_limiter.summary())
+    loop.run_until_complete(client.aio.aclose())
+    loop.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Annotate the corpora with Gemini, all languages sharing one request window")
+    parser.add_argument('languages', nargs='*', choices=list(LANGUAGE_WEIGHTS), default=list(LANGUAGE_WEIGHTS),
+                        help="Languages to annotate (default: all)")
+    return parser
+
+
+def run(args):
+    main(args.languages)
+
+
+if __name__ == '__main__':
+    run(build_parser().parse_args())
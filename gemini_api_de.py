@@ -1,270 +1,51 @@
 import os
 
 import nest_asyncio
-nest_asyncio.apply()
-
-from google import genai
-from rapidfuzz import fuzz
-
-GOOGLE_API_KEY = ""
 
 import asyncio
+from prefix_cache import create_prefix_cache
+from gemini_api import (DEAD_LETTER_PATH, DEDUPLICATE, EXAMPLE_TOKEN_BUDGET, EXAMPLES_PER_ARTICLE, METRICS_PATH,
+                        PREFIX_CACHE_BACKEND, PROMETHEUS_PATH, RESPONSE_CACHE_PATH, api_rate_limiter, build_requests,
+                        close_stages, create_client, process_grouped_documents)
+from request_metrics import RequestMetrics
+from response_cache import ResponseCache
+from dead_letter import DeadLetterQueue
+from exemplar_cache import load_compiled
 import json
-from tqdm import tqdm
-from aiolimiter import AsyncLimiter
-import docx
-
-
-api_rate_limiter = AsyncLimiter(max_rate=10, time_period=1)
-
-MAX_RETRIES = 3
-
-
-def create_spanned_annotations_json(article_text, annotations_str):
-    annotations = []
-    # Split the annotation string into lines and remove any leading/trailing whitespace
-    lines = [line.strip() for line in annotations_str.strip().split('\n')]
-
-    # A variable to ensure we don't find the same text snippet twice.
-    # We will always search from the end of the last found span.
-    search_from_index = 0
-
-    # Iterate through the lines two at a time (one for Label, one for Text)
-    for i in range(0, len(lines), 2):
-        # Ensure we have a valid pair of Label and Text lines
-        if i + 1 < len(lines) and lines[i].startswith("Label:") and lines[i + 1].startswith("Text:"):
-
-            # Extract the label and the text content
-            label = lines[i].replace("Label:", "").strip()
-            text = lines[i + 1].replace("Text:", "").strip()
-
-            # Remove potential surrounding quotes from the text to search for
-            if text.startswith('"') and text.endswith('"'):
-                text = text[1:-1]
-
-            # Find the start position of the text in the article
-            # Begin the search from the end of the last match
-            start_pos = article_text.find(text, search_from_index)
-
-            if start_pos != -1:
-                end_pos = start_pos + len(text)
-
-                annotations.append({
-                    "Label": label,
-                    "Text": text,
-                    "Span": [start_pos, end_pos]
-                })
-
-                # Update the search position for the next iteration
-                search_from_index = end_pos
-            else:
-                # --- CORRECTED FUZZY MATCHING LOGIC ---
-                # If no exact match, search for the best fuzzy match.
-
-                # --- Configuration ---
-                MIN_SIMILARITY_THRESHOLD = 80  # Adjusted threshold for potentially difficult matches
-
-                # Search the rest of the article from the last known point
-                search_area = article_text[search_from_index:]
-
-                if not search_area: continue  # Skip if there's nothing left to search
-
-                try:
-                    # This function returns a ScoreAlignment object with indices of the best match
-                    alignment = fuzz.partial_ratio_alignment(
-                        text,
-                        search_area,
-                        score_cutoff=MIN_SIMILARITY_THRESHOLD
-                    )
-
-                    if alignment:
-                        # **THE FIX IS HERE:** Reconstruct the matched text using the returned indices
-                        match_start_relative = alignment.dest_start
-                        match_end_relative = alignment.dest_end
-                        best_match_text = search_area[match_start_relative:match_end_relative]
-
-                        # Convert relative indices to absolute positions in the full article
-                        best_start_pos = search_from_index + match_start_relative
-                        best_end_pos = search_from_index + match_end_relative
-
-                        # Inform the user about the correction
-                        print(f"--- Fuzzy Match Found (Corrected) ---")
-                        print(f"  Label: {label}")
-                        print(f"  Original Text: '{text}'")
-                        print(f"  Matched Text:  '{best_match_text}' (Score: {alignment.score:.1f}%)")
-                        print(f"-------------------------------------\n")
-
-                        annotations.append({
-                            "Label": label,
-                            "Text": best_match_text,  # Use the corrected text from the article
-                            "Span": [best_start_pos, best_end_pos]
-                        })
-                        search_from_index = best_end_pos
-                    else:
-                        print(
-                            f"Warning: Could not find a suitable match for the following text (Score < {MIN_SIMILARITY_THRESHOLD}%):\n'{text}'\n")
-
-                except Exception as e:
-                    print(f"An error occurred during fuzzy search for '{text}': {e}")
-                except Exception as e:
-                    print(f"An error occurred during fuzzy search for '{text}': {e}")
-
-    # Convert the list of dictionaries into a nicely formatted JSON string
-    return json.dumps(annotations)
-
-
-def read_docx(docx_path):
-
-    # --- Input Validation ---
-    if not os.path.exists(docx_path):
-        print(f"Error: The file '{docx_path}' does not exist.")
-        return None
-    if not docx_path.lower().endswith('.docx'):
-        print(f"Error: The file '{docx_path}' is not a .docx file.")
-        return None
-
-    # Get the base name of the docx file and change the extension to .txt
-    base_name = os.path.splitext(docx_path)[0]
-    txt_path = base_name + '.txt'
-
-    # --- Read the .docx file ---
-    document = docx.Document(docx_path)
-
-    # --- Extract Text ---
-    # Create a list of all paragraphs in the document
-    full_text = " ".join([para.text for para in document.paragraphs])
-    full_text = " ".join(full_text.split())
-    return full_text, base_name
-
-
-def read_json(path, article):
-    with open(path, "r", encoding='utf-8') as f:
-        data = json.load(f)
-        annotations = []
-        for tag in data:
-            if tag[ "document"] == article:
-                annotations.append((tag["text"], tag["labels"]))
-    return annotations
-
-def get_examples(input_folder, json_with_labels, file_names, n=5):
-    counter = 0
-    article_prompts = []
-    for idx, name in enumerate(file_names):
-        counter += 1
-        if counter <= n:
-            article_prompt = ""
-            full_text, base_name = read_docx(os.path.join(input_folder, name))
-            base_name = base_name.split("/")[-1]
-            annotations = read_json(json_with_labels, base_name)
-            article_prompt += "--- News article ---\n"
-            article_prompt += full_text
-            article_prompt += "\n\n--- Annotations ---\n"
-            for anno in annotations:
-                snippet, label = anno
-                snippet = snippet.split()
-                if len(snippet[-1]) == 1:
-                    snippet = snippet[:-1]
-                if len(snippet[0]) == 1:
-                    snippet = snippet[1:]
-                snippet = ' '.join(snippet).strip()
-                article_prompt += f"Label: {'; '. join(label)}\n"
-                article_prompt += f"Text: \"{snippet}\"\n\n"
-            article_prompts.append(article_prompt)
-    return "\n".join(article_prompts)
-
-
-def get_articles_from_corpus(files, path):
-    article_texts = []
-    article_names = []
-    for f in files:
-        if f.endswith('.txt'):
-            with open(os.path.join(path, f), 'r', encoding='utf8') as fi:
-                text = fi.read()
-                text = " ".join(text.split()).strip()
-                article_texts.append(text)
-                article_names.append(f)
-    return article_texts, article_names
 
-async def process_document(i, document, delay=1):
-    """
-    Process a single document: wait for a given delay, then send the prompt to the Gemini model,
-    enforcing the API rate limit with a limiter.
-
-    After receiving the response, the function attempts to clean and evaluate the text.
-    If that fails, it retries the LLM call up to MAX_RETRIES times.
-    """
 
-    client = genai.Client(api_key=GOOGLE_API_KEY)
+# The prefix cache, response cache and dead-letter file are shared with the other corpora and set in
+# gemini_api; the settings below only apply to the German corpus
 
-    prompt = document['prompt']
-    print(prompt)
+# Skip articles whose id is already in the output file, so a crashed run can simply be restarted
+RESUME = True
 
+# Many hits in the NewsEye corpus are single sentences, so short articles are packed into one prompt
+# up to this many article tokens (None sends every article alone)
+BATCH_TOKEN_BUDGET = 1500
+MAX_ARTICLES_PER_BATCH = 10
 
-    attempt = 0
-    while attempt < MAX_RETRIES:
-        try:
-            await asyncio.sleep(delay)
-            async with api_rate_limiter:
-                result = await client.aio.models.generate_content(
-                    model='gemini-2.5-pro',
-                    contents=[
-                        prompt,
-                    ]
-                )
-            text = result.text
-            return i, text, document
+# Many hits are ads, captions or fragments of a few words, so articles that are too short, mostly
+# digits or never mention children are skipped without a request (see triage.py)
+TRIAGE = True
 
-        except Exception as e:
-            attempt += 1
-            if attempt >= MAX_RETRIES:
-                return i, f"Error after {MAX_RETRIES} retries: {e}"
+# Articles longer than this many tokens are split into overlapping segments (None sends every article whole)
+MAX_ARTICLE_TOKENS = 6000
+SEGMENT_OVERLAP_TOKENS = 200
 
+# Choose the worked examples of every article by similarity instead of sending the first five
+# (see DYNAMIC_EXAMPLES in gemini_api)
+DYNAMIC_EXAMPLES = False
 
-async def process_grouped_documents(documents_grouped, output_path, current_chunk):
-    """
-    Processes all documents in parallel by creating tasks for each document.
-    documents_grouped is a list of tuples (original_index, document).
-    Uses asyncio.as_completed to yield tasks as they finish, updating a progress bar.
-    Returns a dictionary mapping the original document indices to their generated text.
-    """
 
-    tasks = [
-        asyncio.create_task(process_document(i, document))
-        for i, document in documents_grouped
-    ]
-    output_file = open(output_path, 'a', encoding='utf-8')
-
-    for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Processing Documents"):
-        try:
-            all_output = await future
-            if len(all_output) == 3:
-                i, output_text, document = all_output
-            else:
-                print('Error with output: ')
-                print(all_output)
-                continue
-            example = {}
-            example["id"] = document['id']
-            example["article"] = document['article']
-            processed_annotations = create_spanned_annotations_json(document['article'], output_text)
-            example["annotations"] = processed_annotations
-            json_line = json.dumps(example, ensure_ascii=False)  # Convert dictionary to a JSON string
-            output_file.write(json_line + '\n')
-        except Exception as e:
-            print('Error in generation:')
-            print(e)
-            continue
-    output_file.close()
+GERMAN = {
+    "output_path": "results/articles_de_corpus_annotated.jsonl",
+    "input_folder": "data/annotated_data/de/atlasti_annotation-german",
+    "json_with_labels": "data/annotated_data/de/training_extended.json",
+    "corpus_path": "data/test_data/de/corpus_kinderarbeit_onb-labs"
+}
 
-
-if __name__ == '__main__':
-    n = 5
-    output_path = 'results/articles_de_corpus_annotated.jsonl'
-    input_folder = "data/annotated_data/de/atlasti_annotation-german"
-    json_with_labels = "data/annotated_data/de/training_extended.json"
-    file_names = os.listdir(input_folder)
-    examples = get_examples(input_folder, json_with_labels, file_names, n)
-    prompt1 = """You are a history expert specializing in the study of child labor. Your task is to annotate passages in historical newspaper articles that discuss child labor. You will tag segments of the text according to the specific aspect of the discourse they represent.
+TAGS_AND_INSTRUCTIONS = """You are a history expert specializing in the study of child labor. Your task is to annotate passages in historical newspaper articles that discuss child labor. You will tag segments of the text according to the specific aspect of the discourse they represent.
 Below is a list of tags with descriptions of what each tag covers. Use these tags to annotate the provided text.
 
 Annotation Tags and Descriptions:
@@ -388,24 +169,186 @@ Description:
     • Cases of violence, abuse, or exploitation within workplaces.
 
 Here are examples of news articles annotated according to the tags defined above. Note that the same text snippet can have more than one tag and that tags are separated by semicolon.\n\n"""
-    instructions = prompt1 + examples
-    corpus_path = "data/test_data/de/corpus_kinderarbeit_onb-labs"
-    corpus_files = os.listdir(corpus_path)
-    articles, ids = get_articles_from_corpus(corpus_files, corpus_path)
-    all_docs = []
-    print("All corpus files:", len(corpus_files))
-    for id, art in zip(ids, articles):
-        whole_prompt = instructions
-        whole_prompt += "Please annotate the news article below in the same manner as in the example above. Return only annotations and nothing else. Do not change the extracted text in any way.\n\n"
-        whole_prompt += "\n--- News article ---\n"
-        whole_prompt += art
-        whole_prompt += "\n--- Annotations ---\n"
-        doc = {'id': id, 'prompt': whole_prompt, 'article': art}
-        all_docs.append(doc)
-
-    chunks = 10
-    for i in range(0, len(all_docs), chunks):
-        print("Chunk:", i)
-        asyncio.run(process_grouped_documents(enumerate(all_docs[i:i + chunks]), output_path, i))
 
 
+def read_docx(docx_path):
+
+    # --- Input Validation ---
+    if not os.path.exists(docx_path):
+        print(f"Error: The file '{docx_path}' does not exist.")
+        return None
+    if not docx_path.lower().endswith('.docx'):
+        print(f"Error: The file '{docx_path}' is not a .docx file.")
+        return None
+
+    # Get the base name of the docx file and change the extension to .txt
+    base_name = os.path.splitext(docx_path)[0]
+    txt_path = base_name + '.txt'
+
+    # The text is only extracted from the .docx again when the file changes
+    full_text = load_compiled('docx:' + docx_path, [docx_path], lambda: extract_docx_text(docx_path))
+    return full_text, base_name
+
+
+def extract_docx_text(docx_path):
+    # --- Read the .docx file ---
+    import docx
+    document = docx.Document(docx_path)
+
+    # --- Extract Text ---
+    # Create a list of all paragraphs in the document
+    full_text = " ".join([para.text for para in document.paragraphs])
+    full_text = " ".join(full_text.split())
+    return full_text
+
+
+def index_annotations(path):
+    """The (text, labels) annotations of the ATLAS.ti export, grouped by document."""
+    with open(path, "r", encoding='utf-8') as f:
+        data = json.load(f)
+    annotations = {}
+    for tag in data:
+        annotations.setdefault(tag["document"], []).append((tag["text"], tag["labels"]))
+    return annotations
+
+
+def read_annotations(path):
+    # Loaded once per set of examples and passed to example_prompt, instead of once per example article
+    return load_compiled('annotations:' + path, [path], lambda: index_annotations(path))
+
+def example_prompt(input_folder, annotations_by_document, name):
+    """
+    The article text of one worked example and the example as it is written into the prompt.
+    annotations_by_document is the index of the ATLAS.ti export returned by read_annotations.
+    """
+    article_prompt = ""
+    full_text, base_name = read_docx(os.path.join(input_folder, name))
+    base_name = base_name.split("/")[-1]
+    annotations = annotations_by_document.get(base_name, [])
+    article_prompt += "--- News article ---\n"
+    article_prompt += full_text
+    article_prompt += "\n\n--- Annotations ---\n"
+    for anno in annotations:
+        snippet, label = anno
+        snippet = snippet.split()
+        if len(snippet[-1]) == 1:
+            snippet = snippet[:-1]
+        if len(snippet[0]) == 1:
+            snippet = snippet[1:]
+        snippet = ' '.join(snippet).strip()
+        article_prompt += f"Label: {'; '. join(label)}\n"
+        article_prompt += f"Text: \"{snippet}\"\n\n"
+    return full_text, article_prompt
+
+
+def get_examples(input_folder, json_with_labels, file_names, n=5):
+    article_prompts = []
+    annotations_by_document = read_annotations(json_with_labels)
+    for name in file_names[:n]:
+        article_prompts.append(example_prompt(input_folder, annotations_by_document, name)[1])
+    return "\n".join(article_prompts)
+
+
+def exemplar_index(config):
+    """TF-IDF index over every annotated German example (see DYNAMIC_EXAMPLES)."""
+    from exemplar_retrieval import ExemplarIndex
+
+    annotations_by_document = read_annotations(config["json_with_labels"])
+    exemplars = [example_prompt(config["input_folder"], annotations_by_document, name)
+                 for name in os.listdir(config["input_folder"]) if name.lower().endswith('.docx')]
+    return ExemplarIndex(exemplars, EXAMPLES_PER_ARTICLE, EXAMPLE_TOKEN_BUDGET)
+
+
+def iter_articles_from_corpus(path):
+    """Yield (file name, article) pairs while walking the corpus directory, reading one file at a time."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith('.txt'):
+                with open(entry.path, 'r', encoding='utf8') as fi:
+                    text = fi.read()
+                    text = " ".join(text.split()).strip()
+                yield entry.name, text
+
+
+def get_articles_from_corpus(files, path):
+    article_texts = []
+    article_names = []
+    for f in files:
+        if f.endswith('.txt'):
+            with open(os.path.join(path, f), 'r', encoding='utf8') as fi:
+                text = fi.read()
+                text = " ".join(text.split()).strip()
+                article_texts.append(text)
+                article_names.append(f)
+    return article_texts, article_names
+
+
+def get_instructions(config, n=5, packed=False):
+    """
+    The instruction prefix shared by every German article: tag descriptions and n worked examples.
+    With n=0 it ends where the examples would start, for examples chosen per article, and with
+    packed=True after the examples, as packed prompts close with their own instructions.
+    """
+    if n == 0:
+        return TAGS_AND_INSTRUCTIONS
+    file_names = os.listdir(config["input_folder"])
+    examples = get_examples(config["input_folder"], config["json_with_labels"], file_names, n)
+    instructions = TAGS_AND_INSTRUCTIONS + examples
+    if packed:
+        return instructions
+    instructions += "Please annotate the news article below in the same manner as in the example above. Return only annotations and nothing else. Do not change the extracted text in any way.\n\n"
+    return instructions
+
+
+def corpus_settings():
+    """The request pipeline settings of the German corpus (see gemini_api.build_requests)."""
+    return {
+        'resume': RESUME,
+        'triage': TRIAGE,
+        'deduplicate': DEDUPLICATE,
+        'max_article_tokens': MAX_ARTICLE_TOKENS,
+        'segment_overlap_tokens': SEGMENT_OVERLAP_TOKENS,
+        'dynamic_examples': DYNAMIC_EXAMPLES,
+        'exemplar_index': exemplar_index,
+        'batch_token_budget': BATCH_TOKEN_BUDGET,
+        'max_articles_per_batch': MAX_ARTICLES_PER_BATCH,
+    }
+
+
+def main():
+    nest_asyncio.apply()
+    instructions = get_instructions(GERMAN, n=0 if DYNAMIC_EXAMPLES else 5, packed=bool(BATCH_TOKEN_BUDGET))
+    client = create_client()
+    prefix_cache = create_prefix_cache(PREFIX_CACHE_BACKEND, client)
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH) if RESPONSE_CACHE_PATH else None
+    dead_letters = DeadLetterQueue(DEAD_LETTER_PATH) if DEAD_LETTER_PATH else None
+    metrics = RequestMetrics(METRICS_PATH, PROMETHEUS_PATH)
+    checkpoints = {}
+    stages = []
+    requests = build_requests("german", GERMAN, corpus_settings(), iter_articles_from_corpus(GERMAN["corpus_path"]),
+                              instructions, prefix_cache, checkpoints, stages)
+    # One event loop and one client for the whole run
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(process_grouped_documents(
+        enumerate(requests), GERMAN["output_path"], client, prefix_cache, checkpoints=checkpoints,
+        response_cache=response_cache, dead_letters=dead_letters, metrics=metrics
+    ))
+    close_stages(stages)
+    print(metrics.summary())
+    metrics.close()
+    if dead_letters is not None:
+        print(dead_letters.summary())
+        dead_letters.close()
+    if prefix_cache is not None:
+        print(prefix_cache.summary())
+        prefix_cache.close()
+    if response_cache is not None:
+        print(response_cache.summary())
+        response_cache.close()
+    print(api_rate_limiter.summary())
+    loop.run_until_complete(client.aio.aclose())
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
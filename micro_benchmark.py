@@ -0,0 +1,275 @@
+"""
+Micro-benchmarks of the hot paths: parsing and aligning responses, reading the corpora, building
+the few-shot examples, exporting the results and counting the labels.
+
+Every benchmark runs on synthetic data generated into a temporary directory (corpora for all four
+scripts, model responses with a chosen share of exact, fuzzy and missing snippets, and annotated
+JSONL files of the given sizes), so no network, API key or result files are needed. The fastest
+of the timings of every benchmark, which is the least disturbed by other load on the machine, is
+compared with the recorded baseline:
+
+    python micro_benchmark.py                          # compare with micro_benchmark_baselines.json
+    python micro_benchmark.py --save                   # record the current times as the baseline
+    python micro_benchmark.py --sizes 10000 1000000    # JSONL benchmarks on 10k and 1M lines
+    python micro_benchmark.py --filter count_labels --check   # exit code 1 on a regression
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import analyse_annotations
+import convert_to_json
+import gemini_api
+import gemini_api_de
+from annotation_stream import AnnotationStreamParser, parse_annotation_pairs
+from benchmark import synthetic_article
+from exemplar_cache import load_compiled
+from segmentation import split_article
+
+BASELINES_PATH = "micro_benchmark_baselines.json"
+
+# Changes of the fastest timing smaller than this are reported as noise
+NOISE_THRESHOLD = 0.2
+
+CJK_CHARACTERS = "童工廠學校法律時間工資兒童家長檢查勞動政府教育衛生貧困機器罷工改革礦"
+LABELS = ["Economic Context", "Education", "Health", "Legal Framework", "Working Conditions", "Gender"]
+SOURCES = ["NYT", "Times", "Herald", "Tribune"]
+
+
+def synthetic_chinese_article(rng, min_sentences=1, max_sentences=20):
+    sentences = []
+    for _ in range(rng.randint(min_sentences, max_sentences)):
+        sentences.append("".join(rng.choice(CJK_CHARACTERS) for _ in range(rng.randint(8, 30))) + "。")
+    return "".join(sentences)
+
+
+def noisy_copy(rng, text, rate=0.05):
+    """text with about rate of its characters replaced, like OCR errors or an inexact quote."""
+    chars = list(text)
+    for _ in range(max(1, int(len(chars) * rate))):
+        chars[rng.randrange(len(chars))] = rng.choice("abcdefghijklmnopqrstuvwxyz")
+    return "".join(chars)
+
+
+def synthetic_response(rng, article, n=10, exact=0.7, fuzzy=0.2):
+    """
+    A model response with n Label:/Text: pairs quoting the article: a share exact of the snippets
+    are verbatim, fuzzy are slightly changed and the rest do not occur in the article at all.
+    """
+    lines = []
+    for _ in range(n):
+        length = rng.randint(40, 160)
+        start = rng.randrange(max(1, len(article) - length))
+        snippet = article[start:start + length]
+        kind = rng.random()
+        if kind >= exact + fuzzy:
+            snippet = synthetic_article(rng, 1, 1)[:length]
+        elif kind >= exact:
+            snippet = noisy_copy(rng, snippet)
+        lines.append(f"Label: {rng.choice(LABELS)}\nText: \"{snippet}\"\n")
+    return "\n".join(lines)
+
+
+def write_corpora(directory, n, seed=0):
+    """Corpus files of n articles in the format of every script: three CSVs and a directory of .txt files."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for language in ['english', 'french', 'chinese']:
+        sep, text_column = gemini_api.CORPUS_FORMATS.get(language, gemini_api.DEFAULT_CORPUS_FORMAT)
+        path = os.path.join(directory, f"corpus_{language}.csv")
+        with open(path, 'w', encoding='utf8', newline='') as f:
+            writer = csv.writer(f, delimiter=sep)
+            writer.writerow(['date', 'id', text_column])
+            for i in range(n):
+                article = (synthetic_chinese_article if language == 'chinese' else synthetic_article)(rng, 1, 20)
+                writer.writerow([f"{1890 + i % 60}-01-01", f"{SOURCES[i % 4]}_{i}", article])
+        paths[language] = path
+    german = os.path.join(directory, "corpus_german")
+    os.makedirs(german)
+    for i in range(n):
+        with open(os.path.join(german, f"article_{i}.txt"), 'w', encoding='utf8') as f:
+            f.write(synthetic_article(rng, 1, 20))
+    paths['german'] = german
+    return paths
+
+
+def write_annotated_jsonl(path, lines, seed=0):
+    """An annotated JSONL in the output format, with short articles and 0-6 annotations per line."""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(lines):
+            article = synthetic_article(rng, 1, 4)
+            annotations = []
+            for _ in range(rng.randint(0, 6)):
+                start = rng.randrange(len(article))
+                end = min(len(article), start + rng.randint(10, 80))
+                label = "; ".join(rng.sample(LABELS, rng.randint(1, 2)))
+                annotations.append({"Label": label, "Text": article[start:end], "Span": [start, end]})
+            record = {"id": f"{1850 + i % 100}-01-01-_{SOURCES[i % 4]}_{i}", "article": article,
+                      "annotations": annotations}
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return path
+
+
+def benchmarks(directory, sizes, seed=0):
+    """
+    (name, function) of every benchmark, each function timed as one run. The data they need is
+    generated up front, so it is not part of the timings.
+    """
+    rng = random.Random(seed)
+    cases = []
+
+    # --- Parsing and alignment of model responses ---
+    articles = [synthetic_article(rng, 20, 40) for _ in range(20)]
+    for exact, fuzzy in [(1.0, 0.0), (0.7, 0.2), (0.4, 0.3)]:
+        responses = [synthetic_response(rng, article, 10, exact, fuzzy) for article in articles]
+        missing = round(1 - exact - fuzzy, 1)
+        cases.append((f"create_spanned_annotations[exact={exact},fuzzy={fuzzy},missing={missing}]",
+                      lambda responses=responses: [gemini_api.create_spanned_annotations(article, response)
+                                                   for article, response in zip(articles, responses)]))
+    responses = [synthetic_response(rng, article, 10, 0.7, 0.2) for article in articles]
+    cases.append(("parse_annotation_pairs", lambda: [parse_annotation_pairs(response) for response in responses]))
+
+    def stream_parse():
+        for response in responses:
+            parser = AnnotationStreamParser()
+            for k in range(0, len(response), 40):
+                parser.feed(response[k:k + 40])
+            parser.close()
+    cases.append(("AnnotationStreamParser.feed[40 char chunks]", stream_parse))
+    long_article = synthetic_article(rng, 2000, 2000)
+    cases.append(("split_article[long article]", lambda: split_article(long_article, 6000, 200)))
+
+    # --- Corpus readers of the four scripts ---
+    corpora = write_corpora(os.path.join(directory, "corpora"), 2000, seed)
+    for language in ['english', 'french', 'chinese']:
+        cases.append((f"get_articles_from_corpus[{language},2000]",
+                      lambda language=language: gemini_api.get_articles_from_corpus(corpora[language], language)))
+    cases.append(("get_articles_from_corpus[german,2000]", lambda: gemini_api_de.get_articles_from_corpus(
+        os.listdir(corpora['german']), corpora['german'])))
+
+    # --- Few-shot examples, from the annotator files and from the exemplar cache ---
+    for language, config in gemini_api.LANGUAGES.items():
+        path = config["path_articles"]
+        if not os.path.isdir(path):
+            continue
+        groups = gemini_api.example_files(path)
+        sources = [input_json for group in groups for input_json in group]
+
+        def compile_examples(groups=groups):
+            return [[gemini_api.read_example(input_json) for input_json in group] for group in groups]
+        cache_dir = os.path.join(directory, "exemplars")
+        load_compiled('examples:' + path, sources, compile_examples, cache_dir)
+        cases.append((f"get_examples[{language},uncached]", lambda compile_examples=compile_examples: "\n".join(
+            gemini_api.format_example(example) for group in compile_examples()[:5] for example in group)))
+        cases.append((f"get_examples[{language},cached]", lambda path=path, sources=sources: "\n".join(
+            gemini_api.format_example(example)
+            for group in load_compiled('examples:' + path, sources, None, cache_dir)[:5] for example in group)))
+
+    # --- Export and analysis of annotated JSONL files ---
+    for lines in sizes:
+        path = write_annotated_jsonl(os.path.join(directory, f"annotated_{lines}.jsonl"), lines, seed)
+        output = os.path.join(directory, f"annotated_{lines}.json")
+        cases.append((f"convert_jsonl_to_formatted_json[{lines}]",
+                      lambda path=path, output=output: convert_to_json.convert_jsonl_to_formatted_json(path, output)))
+        cases.append((f"count_labels[{lines}]", lambda path=path: analyse_annotations.count_labels(path)))
+        label_counts, _ = analyse_annotations.count_labels(path)
+        cases.append((f"chart_tables[{lines}]", lambda label_counts=label_counts:
+                      analyse_annotations.chart_tables(label_counts)))
+        charts = os.path.join(directory, "charts_{lang}")
+        cases.append((f"analyze_corpus[{lines}]", lambda path=path, label_counts=label_counts:
+                      analyse_annotations.analyze_corpus(path, 'en', False, True, label_counts, charts)))
+    return cases
+
+
+def time_function(function, repeat, min_time):
+    """Median and minimum of repeat timings; a run is repeated within a timing until it takes min_time."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+        start = time.perf_counter()
+        function()
+        once = time.perf_counter() - start
+        loops = max(1, int(min_time / max(once, 1e-9)))
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(loops):
+                function()
+            timings.append((time.perf_counter() - start) / loops)
+    return statistics.median(timings), min(timings)
+
+
+def machine():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def run(args):
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, 'r', encoding='utf-8') as f:
+            baselines = json.load(f)
+    recorded = baselines.get('results', {})
+    if recorded and baselines.get('machine') != machine():
+        print(f"Note: the baselines were recorded on {baselines.get('machine')}")
+
+    directory = tempfile.mkdtemp(prefix="micro_benchmark_")
+    results = {}
+    regressions = []
+    try:
+        print("Generating synthetic data ...")
+        cases = benchmarks(directory, args.sizes, args.seed)
+        print(f"{'benchmark':<62}{'best':>12}{'median':>12}{'baseline':>12}{'change':>10}")
+        for name, function in cases:
+            if args.filter and args.filter not in name:
+                continue
+            median, best = time_function(function, args.repeat, args.min_time)
+            results[name] = {'median': median, 'min': best}
+            line = f"{name:<62}{best * 1000:>10.3f}ms{median * 1000:>10.3f}ms"
+            if name in recorded:
+                change = best / recorded[name]['min'] - 1
+                flag = '' if abs(change) < args.threshold else (' slower' if change > 0 else ' faster')
+                line += f"{recorded[name]['min'] * 1000:>10.3f}ms{change:>+10.1%}{flag}"
+                if change >= args.threshold:
+                    regressions.append(name)
+            print(line)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.save:
+        recorded.update(results)
+        with open(args.baselines, 'w', encoding='utf-8') as f:
+            json.dump({'machine': machine(), 'results': dict(sorted(recorded.items()))}, f, indent=2)
+            f.write('\n')
+        print(f"Saved {len(results)} baselines to {args.baselines}")
+    for name in regressions:
+        print(f"REGRESSION: {name} is more than {args.threshold:.0%} slower than its baseline")
+    return 1 if args.check and regressions else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the parsing, alignment, reader and analysis hot paths")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000], help="Lines of the annotated JSONL benchmarks")
+    parser.add_argument('--repeat', type=int, default=5, help="Timings per benchmark")
+    parser.add_argument('--min-time', type=float, default=0.2, help="Minimum seconds per timing, for fast benchmarks")
+    parser.add_argument('--filter', help="Only run the benchmarks whose name contains this")
+    parser.add_argument('--baselines', default=BASELINES_PATH)
+    parser.add_argument('--save', action='store_true', help="Record the results as the new baselines")
+    parser.add_argument('--threshold', type=float, default=NOISE_THRESHOLD, help="Relative change reported as a change")
+    parser.add_argument('--check', action='store_true', help="Exit with code 1 when a benchmark regressed")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+if __name__ == '__main__':
+    sys.exit(run(build_parser().parse_args()))
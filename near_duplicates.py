@@ -0,0 +1,160 @@
+"""
+Near-duplicate detection of the articles before they are annotated.
+
+Newspapers often reprinted the same wire story, with small differences from OCR errors or edits.
+Every article gets a MinHash signature over its character shingles, and locality sensitive hashing
+(banding the signature) finds earlier articles with a similar signature in a single pass over the
+corpus. The first article of a group is annotated as usual; the others reuse its annotations, which
+are aligned with their own text when it is done, without a request of their own.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Length of the character shingles; whitespace is collapsed and case ignored first
+SHINGLE_CHARS = 5
+
+# MinHash signature size, split into LSH_BANDS bands. With 16 bands of 8 rows, pairs of articles
+# are likely to become candidates from a Jaccard similarity of about 0.7 on
+NUM_PERMUTATIONS = 128
+LSH_BANDS = 16
+
+# Candidates whose estimated Jaccard similarity is at least this much are treated as the same article
+DUPLICATE_THRESHOLD = 0.8
+
+# Shingles hashed at a time while computing a signature, which bounds the temporary array to
+# SIGNATURE_CHUNK x NUM_PERMUTATIONS 64-bit values however long the article is
+SIGNATURE_CHUNK = 4096
+
+
+class Cluster:
+    """
+    An article that is annotated (the representative) and the near-duplicates waiting for its
+    annotations. Only the representative's id, sketch and, once done, annotations are kept. The
+    sketch holds the lowest byte of every MinHash value (b-bit MinHash), 128 bytes instead of the
+    512 of the full signature.
+    """
+
+    __slots__ = ('id', 'sketch', 'stats', 'annotations', 'failed', 'waiting')
+
+    def __init__(self, id, sketch, stats):
+        self.id = id
+        self.sketch = sketch
+        self.stats = stats
+        self.annotations = None
+        self.failed = False
+        self.waiting = []
+
+    def resolve(self, annotations):
+        """Store the annotations of the representative; returns the duplicates that waited for them."""
+        self.annotations = [{"Label": annotation["Label"], "Text": annotation["Text"]} for annotation in annotations]
+        waiting, self.waiting = self.waiting, []
+        return waiting
+
+    def fail(self):
+        """The representative failed for good; returns the duplicates that waited for it."""
+        self.failed = True
+        waiting, self.waiting = self.waiting, []
+        self.stats['failed'] += len(waiting)
+        return waiting
+
+
+class Deduplicator:
+    """
+    Streaming MinHash/LSH clustering of the request documents of one corpus. Memory grows with the
+    number of representatives (their sketch and one 64-bit key per band, about 1.6 KB each before
+    annotations), not with the size of the articles.
+    """
+
+    def __init__(self, language, threshold=DUPLICATE_THRESHOLD, num_permutations=NUM_PERMUTATIONS, bands=LSH_BANDS,
+                 shingle_chars=SHINGLE_CHARS, seed=0):
+        self.language = language
+        self.threshold = threshold
+        self.bands = bands
+        self.shingle_chars = shingle_chars
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hash functions: the top 32 bits of a * x + b (mod 2^64), with a odd
+        self.a = rng.integers(0, 2 ** 63, num_permutations, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 2 ** 63, num_permutations, dtype=np.uint64)
+        self.powers = np.uint64(1000003) ** np.arange(shingle_chars, dtype=np.uint64)
+        # Every band is hashed to one 64-bit key; the offsets keep equal bands of different positions apart
+        self.band_multipliers = rng.integers(0, 2 ** 63, num_permutations // bands, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.band_offsets = rng.integers(0, 2 ** 63, bands, dtype=np.uint64)
+        self.buckets = {}
+        self.stats = {'articles': 0, 'representatives': 0, 'duplicates': 0, 'projected': 0, 'failed': 0}
+
+    def signature(self, article):
+        """MinHash signature of an article, or None if it is shorter than one shingle."""
+        text = " ".join(article.lower().split())
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        if len(codes) < self.shingle_chars:
+            return None
+        shingles = np.unique(sliding_window_view(codes, self.shingle_chars) @ self.powers)
+        signature = np.full(len(self.a), np.iinfo(np.uint64).max, dtype=np.uint64)
+        for start in range(0, len(shingles), SIGNATURE_CHUNK):
+            chunk = shingles[start:start + SIGNATURE_CHUNK, None]
+            np.minimum(signature, ((chunk * self.a + self.b) >> np.uint64(32)).min(axis=0), out=signature)
+        return signature.astype(np.uint32)
+
+    def band_keys(self, signature):
+        """One 64-bit key per band of the signature."""
+        keys = (signature.reshape(self.bands, -1).astype(np.uint64) * self.band_multipliers).sum(axis=1)
+        keys += self.band_offsets
+        keys ^= keys >> np.uint64(31)
+        keys *= np.uint64(0x9E3779B97F4A7C15)
+        keys ^= keys >> np.uint64(29)
+        return keys.tolist()
+
+    def sketch(self, signature):
+        return (signature & 0xFF).astype(np.uint8).tobytes()
+
+    def similarity(self, cluster, sketch):
+        """Jaccard similarity estimated from two sketches, corrected for lowest bytes that are equal by chance."""
+        matches = np.mean(np.frombuffer(cluster.sketch, dtype=np.uint8) == np.frombuffer(sketch, dtype=np.uint8))
+        return (matches - 1 / 256) / (1 - 1 / 256)
+
+    def find(self, sketch, keys):
+        """The cluster of an earlier article that is a near-duplicate, or None."""
+        for key in keys:
+            cluster = self.buckets.get(key)
+            if cluster is not None and self.similarity(cluster, sketch) >= self.threshold:
+                return cluster
+        return None
+
+    def filter(self, documents):
+        """
+        Yield the documents to process. A representative carries its Cluster under 'cluster'. A
+        duplicate of an article that is already annotated is yielded with 'duplicate_of', and is
+        written without a request; one whose representative is still in flight is held back in the
+        cluster until the representative's example is built (or the representative fails).
+        """
+        for document in documents:
+            self.stats['articles'] += 1
+            signature = self.signature(document['article'])
+            if signature is None:
+                yield document
+                continue
+            keys = self.band_keys(signature)
+            sketch = self.sketch(signature)
+            cluster = self.find(sketch, keys)
+            if cluster is None or cluster.failed:
+                cluster = Cluster(document['id'], sketch, self.stats)
+                for key in keys:
+                    if key not in self.buckets or self.buckets[key].failed:
+                        self.buckets[key] = cluster
+                self.stats['representatives'] += 1
+                yield dict(document, cluster=cluster)
+                continue
+            self.stats['duplicates'] += 1
+            if cluster.annotations is not None:
+                yield dict(document, duplicate_of=cluster)
+            else:
+                cluster.waiting.append(dict(document, duplicate_of=cluster))
+
+    def close(self):
+        # Clusters keep the annotations of every representative, which are not needed after the run
+        self.buckets = {}
+
+    def summary(self):
+        return (f"Near-duplicates ({self.language}): {self.stats['duplicates']} of {self.stats['articles']} articles are reprints of "
+                f"{self.stats['representatives']} annotated articles; {self.stats['projected']} annotated without a request, "
+                f"{self.stats['failed']} failed with their representative")
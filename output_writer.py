@@ -0,0 +1,177 @@
+import asyncio
+import json
+import os
+import time
+
+# Finished examples waiting to be written; producers wait when the queue is full
+WRITER_QUEUE_SIZE = 1000
+# At most this many examples are written with one write and flush
+WRITER_BATCH_SIZE = 100
+# Spans are written to the columnar dataset in part files of at most this many rows
+COLUMNAR_ROWS_PER_FILE = 100000
+
+
+def spans_dataset_path(output_path):
+    """Directory of the Parquet dataset holding the spans of an output JSONL."""
+    return os.path.splitext(output_path)[0] + '_spans'
+
+
+def span_rows(example):
+    """One row per annotation of an example, for the columnar sink."""
+    for annotation in example['annotations']:
+        yield {
+            'id': example['id'],
+            'label': annotation['Label'],
+            'text': annotation['Text'],
+            'span_start': annotation['Span'][0],
+            'span_end': annotation['Span'][1],
+        }
+
+
+class ColumnarSink:
+    """
+    Writes the spans of every example to a Parquet dataset (a directory of part files) with the
+    columns id, label, text, span_start and span_end, so they can be loaded without any JSON
+    parsing, e.g. with pandas.read_parquet(directory).
+
+    Rows are buffered and every part file is written in one go under a temporary name, so the
+    dataset never holds a half-written file. The JSONL stays the reference: the spans buffered at
+    a crash are not in the dataset, and export_spans rebuilds the dataset from the JSONL.
+    """
+
+    def __init__(self, output_path, rows_per_file=COLUMNAR_ROWS_PER_FILE):
+        # Optional dependency, only needed when the columnar output is switched on
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.directory = spans_dataset_path(output_path)
+        self.rows_per_file = rows_per_file
+        self.rows = []
+        os.makedirs(self.directory, exist_ok=True)
+
+    def add(self, examples):
+        for example in examples:
+            self.rows.extend(span_rows(example))
+        if len(self.rows) >= self.rows_per_file:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        name = os.path.join(self.directory, f"part-{time.time_ns()}.parquet")
+        self.pq.write_table(self.pa.Table.from_pylist(self.rows), name + '.tmp', compression='zstd')
+        os.replace(name + '.tmp', name)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+
+def export_spans(output_path):
+    """(Re)build the Parquet span dataset of an output JSONL from scratch."""
+    sink = ColumnarSink(output_path)
+    for name in os.listdir(sink.directory):
+        os.remove(os.path.join(sink.directory, name))
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                example = json.loads(line)
+                if isinstance(example['annotations'], str):
+                    example['annotations'] = json.loads(example['annotations'])
+                sink.add([example])
+    sink.close()
+    return sink.directory
+
+
+class OutputWriter:
+    """
+    The single consumer that appends finished examples to the output JSONL files.
+
+    Examples are queued with put() (waiting while the queue holds WRITER_QUEUE_SIZE of them) and
+    written by one task in batches of whatever has queued up, at most WRITER_BATCH_SIZE: one write
+    and one flush per output file, after which their ids are recorded in the checkpoint, so a
+    checkpointed id always has its line on disk. With columnar=True the spans also go to a
+    ColumnarSink per output file.
+
+    If a write fails (a full disk, or pyarrow missing for the columnar output), the writer task
+    stops: failed becomes true, and put() and close() raise its error instead of waiting forever.
+    """
+
+    def __init__(self, checkpoints=None, columnar=False, queue_size=WRITER_QUEUE_SIZE, batch_size=WRITER_BATCH_SIZE):
+        self.checkpoints = checkpoints if checkpoints is not None else {}
+        self.columnar = columnar
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.files = {}
+        self.sinks = {}
+        self.task = None
+        self.stats = {'examples': 0, 'batches': 0}
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    @property
+    def failed(self):
+        """Whether the writer task stopped with an error."""
+        return self.task is not None and self.task.done() and self.task.exception() is not None
+
+    async def put(self, output_path, example):
+        if self.failed:
+            raise self.task.exception()
+        if not self.queue.full():
+            self.queue.put_nowait((output_path, example))
+            return
+        # Wait for room in the queue, unless the writer dies in the meantime
+        put = asyncio.ensure_future(self.queue.put((output_path, example)))
+        await asyncio.wait([put, self.task], return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            raise self.task.exception()
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            done = batch[-1] is None
+            self.write_batch([item for item in batch if item is not None])
+            if done:
+                return
+
+    def write_batch(self, batch):
+        if not batch:
+            return
+        by_path = {}
+        for output_path, example in batch:
+            by_path.setdefault(output_path, []).append(example)
+        for output_path, examples in by_path.items():
+            if output_path not in self.files:
+                self.files[output_path] = open(output_path, 'a', encoding='utf-8')
+            output_file = self.files[output_path]
+            output_file.write(''.join(json.dumps(example, ensure_ascii=False) + '\n' for example in examples))
+            output_file.flush()
+            checkpoint = self.checkpoints.get(output_path)
+            if checkpoint is not None:
+                checkpoint.mark_many([example['id'] for example in examples])
+            if self.columnar:
+                if output_path not in self.sinks:
+                    self.sinks[output_path] = ColumnarSink(output_path)
+                self.sinks[output_path].add(examples)
+        self.stats['examples'] += len(batch)
+        self.stats['batches'] += 1
+
+    async def close(self):
+        """Write everything still queued, then close the files. Raises the error of a failed writer."""
+        if not self.failed:
+            await self.queue.put(None)
+        try:
+            await self.task
+        finally:
+            for output_file in self.files.values():
+                output_file.close()
+            for sink in self.sinks.values():
+                sink.close()
+
+    def summary(self):
+        return f"Writer: {self.stats['examples']} examples in {self.stats['batches']} batched writes"
@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import time
+
+from token_utils import estimate_tokens
+
+
+class LocalPrefixCache:
+    """
+    Offline stand-in for the Gemini context cache.
+
+    The instruction prefix is registered once and kept in memory. Requests are built by
+    gluing the prefix back in front of the article, so any client (real or fake) receives
+    the same prompt as without caching, while the counters report what would have been saved.
+    """
+
+    def __init__(self):
+        self.prefixes = {}
+        self.used = set()
+        self.stats = {'registered': 0, 'requests': 0, 'prefix_tokens_saved': 0}
+
+    def _name(self, model, prefix):
+        digest = hashlib.sha256((model + '\n' + prefix).encode('utf-8')).hexdigest()
+        return 'local/' + digest[:16]
+
+    def register(self, model, prefix, key=None):
+        name = self._name(model, prefix)
+        if name not in self.prefixes:
+            self.prefixes[name] = prefix
+            self.stats['registered'] += 1
+        return name
+
+    def full_prompt(self, name, suffix):
+        return self.prefixes[name] + suffix
+
+    async def refresh(self, name):
+        """Called before every request that uses the prefix; a local prefix never expires."""
+
+    def build_request(self, name, suffix):
+        return [self.prefixes[name] + suffix], None
+
+    def record_usage(self, name, usage_metadata=None):
+        self.stats['requests'] += 1
+        # The first request of every prefix pays for it, every following one is a saving
+        if name in self.used:
+            self.stats['prefix_tokens_saved'] += estimate_tokens(self.prefixes[name])
+        self.used.add(name)
+
+    def close(self):
+        self.prefixes = {}
+        self.used = set()
+
+    def summary(self):
+        return (f"Prefix cache: {self.stats['registered']} prefixes, {self.stats['requests']} requests, "
+                f"{self.stats['prefix_tokens_saved']} prefix tokens saved")
+
+
+class GeminiPrefixCache(LocalPrefixCache):
+    """
+    Registers the static instruction block as a Gemini cached context, so each request
+    only sends the article suffix and references the cache by name.
+
+    Cached contexts expire after ttl_seconds, so the expiry of a context is pushed back (refresh)
+    whenever a request finds less than half of it left, and the context is created again if that fails.
+    Prefixes the API refuses to cache (e.g. below the model's minimum cacheable size) are sent in
+    full with every request instead.
+    """
+
+    def __init__(self, client, ttl_seconds=7200):
+        super().__init__()
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        # Local name -> name of the cached context (None when the prefix could not be cached)
+        self.cache_names = {}
+        self.expires_at = {}
+        self.refreshing = set()
+        self.stats.update({'refreshed': 0, 'uncached': 0})
+
+    def register(self, model, prefix, key=None):
+        local_name = self._name(model, prefix)
+        if local_name not in self.prefixes:
+            self.prefixes[local_name] = prefix
+            self.cache_names[local_name] = None
+            self._create(local_name, model, key)
+            self.stats['registered'] += 1
+        return local_name
+
+    def _create(self, local_name, model, key=None):
+        from google.genai import types
+        try:
+            cache = self.client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    display_name=key or local_name,
+                    contents=[self.prefixes[local_name]],
+                    ttl=f"{self.ttl_seconds}s",
+                )
+            )
+        except Exception as e:
+            print(f"Could not cache the instruction prefix {key or local_name}, sending it in full instead: {e}")
+            self.cache_names[local_name] = None
+            self.stats['uncached'] += 1
+            return
+        self.cache_names[local_name] = cache.name
+        self.expires_at[local_name] = (time.monotonic() + self.ttl_seconds, model, key)
+
+    async def refresh(self, name):
+        """
+        Extend the expiry of the cached context of name if less than half of it is left. The API
+        calls run in a worker thread, so requests in flight are not held up meanwhile.
+        """
+        if self.cache_names[name] is None or name in self.refreshing:
+            return
+        expires_at, model, key = self.expires_at[name]
+        if expires_at - time.monotonic() > self.ttl_seconds / 2:
+            return
+        from google.genai import types
+        self.refreshing.add(name)
+        try:
+            await asyncio.to_thread(
+                self.client.caches.update,
+                name=self.cache_names[name],
+                config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"),
+            )
+            self.expires_at[name] = (time.monotonic() + self.ttl_seconds, model, key)
+        except Exception as e:
+            print(f"Could not extend cached context {self.cache_names[name]}, creating it again: {e}")
+            await asyncio.to_thread(self._create, name, model, key)
+        finally:
+            self.refreshing.discard(name)
+        self.stats['refreshed'] += 1
+
+    def build_request(self, name, suffix):
+        if self.cache_names[name] is None:
+            return [self.prefixes[name] + suffix], None
+        from google.genai import types
+        return [suffix], types.GenerateContentConfig(cached_content=self.cache_names[name])
+
+    def record_usage(self, name, usage_metadata=None):
+        self.stats['requests'] += 1
+        if self.cache_names[name] is None:
+            return
+        cached_tokens = getattr(usage_metadata, 'cached_content_token_count', None)
+        if cached_tokens is None:
+            cached_tokens = estimate_tokens(self.prefixes[name])
+        self.stats['prefix_tokens_saved'] += cached_tokens
+
+    def close(self):
+        # Cached contents are billed for storage until they expire, so drop them when the run is done
+        for cache_name in self.cache_names.values():
+            if cache_name is None:
+                continue
+            try:
+                self.client.caches.delete(name=cache_name)
+            except Exception as e:
+                print(f"Could not delete cached context {cache_name}: {e}")
+        self.prefixes = {}
+        self.cache_names = {}
+        self.expires_at = {}
+
+    def summary(self):
+        return (super().summary() + f", {self.stats['refreshed']} expiry extensions, "
+                f"{self.stats['uncached']} prefixes sent uncached")
+
+
+def create_prefix_cache(backend, client=None):
+    if backend == "gemini":
+        return GeminiPrefixCache(client)
+    if backend == "local":
+        return LocalPrefixCache()
+    return None
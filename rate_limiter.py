@@ -0,0 +1,95 @@
+import asyncio
+import random
+import time
+
+
+class AdaptiveRateLimiter:
+    """
+    Rate limiter that budgets both requests per minute and tokens per minute.
+
+    Both budgets are token buckets refilled continuously. A request waits until both buckets
+    are non-negative and then takes its share, so a prompt larger than one second worth of
+    tokens still goes through and is paid back by the following requests.
+    The allowed rate adapts AIMD style: it is cut by `decrease` on every quota error and
+    grows back by `increase` (as a fraction of the configured quota) on every success.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, burst_seconds=1.0,
+                 min_fraction=0.05, increase=0.02, decrease=0.5,
+                 backoff_base=1.0, backoff_cap=60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.burst_seconds = burst_seconds
+        self.min_fraction = min_fraction
+        self.increase = increase
+        self.decrease = decrease
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self.fraction = 1.0
+        self.request_level = self._capacity(requests_per_minute)
+        self.token_level = self._capacity(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+        self.stats = {'requests': 0, 'quota_errors': 0, 'waited_seconds': 0.0}
+
+    def _capacity(self, per_minute):
+        return per_minute / 60 * self.burst_seconds
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_level = min(self._capacity(self.requests_per_minute),
+                                 self.request_level + elapsed * self.requests_per_minute * self.fraction / 60)
+        self.token_level = min(self._capacity(self.tokens_per_minute),
+                               self.token_level + elapsed * self.tokens_per_minute * self.fraction / 60)
+
+    def _wait_time(self):
+        wait = max(0.0, self.paused_until - time.monotonic())
+        if self.request_level < 0:
+            wait = max(wait, -self.request_level * 60 / (self.requests_per_minute * self.fraction))
+        if self.token_level < 0:
+            wait = max(wait, -self.token_level * 60 / (self.tokens_per_minute * self.fraction))
+        return wait
+
+    async def acquire(self, tokens):
+        """Wait until the request and token budgets allow a request of the given (estimated) size."""
+        start = time.monotonic()
+        # The lock keeps waiting requests in order, so a large prompt is not starved by small ones
+        async with self.lock:
+            while True:
+                self._refill()
+                wait = self._wait_time()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.request_level -= 1
+            self.token_level -= tokens
+        self.stats['requests'] += 1
+        self.stats['waited_seconds'] += time.monotonic() - start
+
+    def success(self, estimated_tokens=0, actual_tokens=None):
+        """Additive increase of the rate; corrects the token budget once the real usage is known."""
+        self.fraction = min(1.0, self.fraction + self.increase)
+        if actual_tokens is not None:
+            self.token_level += estimated_tokens - actual_tokens
+
+    def throttle(self, attempt):
+        """Multiplicative decrease of the rate after a quota error, and a pause for all requests."""
+        self.stats['quota_errors'] += 1
+        self.fraction = max(self.min_fraction, self.fraction * self.decrease)
+        self.paused_until = max(self.paused_until, time.monotonic() + self.backoff(attempt))
+
+    def backoff(self, attempt):
+        """Exponential backoff with full jitter for the given (1-based) retry attempt."""
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def is_quota_error(e):
+        return getattr(e, 'code', None) == 429 or 'RESOURCE_EXHAUSTED' in str(e)
+
+    def summary(self):
+        return (f"Rate limiter: {self.stats['requests']} requests, {self.stats['quota_errors']} quota errors, "
+                f"{self.stats['waited_seconds']:.1f}s waited, rate at {self.fraction:.0%} of quota")
@@ -0,0 +1,126 @@
+"""
+Re-submit only the articles recorded in the dead-letter file, with their own retry policy.
+
+    python replay.py --max-retries 6 --requests-per-minute 60
+
+Articles already written to their output file in the meantime are skipped. Articles that fail
+again make up the new dead-letter file once the replay is over, and the replayed one is kept
+next to it with a .replayed suffix, so replay can simply be run again. An interrupted replay
+leaves the dead-letter file as it was.
+"""
+import argparse
+import asyncio
+import os
+
+import gemini_api
+import gemini_api_de
+from checkpoint import Checkpoint
+from dead_letter import DeadLetterQueue, read_dead_letters
+from prefix_cache import create_prefix_cache
+from rate_limiter import AdaptiveRateLimiter
+from response_cache import ResponseCache
+from request_metrics import RequestMetrics
+from segmentation import split_long_documents
+
+# Retry policy of a replay: the articles got here because the normal policy gave up on them,
+# so they get more attempts and longer backoffs
+REPLAY_MAX_RETRIES = 6
+REPLAY_BACKOFF_BASE = 5.0
+REPLAY_BACKOFF_CAP = 300.0
+
+
+def language_configs():
+    """(language, config, get_instructions) of every corpus, keyed by its output path."""
+    configs = {config["output_path"]: (language, config, gemini_api.get_instructions)
+               for language, config in gemini_api.LANGUAGES.items()}
+    configs[gemini_api_de.GERMAN["output_path"]] = ("german", gemini_api_de.GERMAN, gemini_api_de.get_instructions)
+    return configs
+
+
+def replay_requests(entries, prefix_cache, checkpoints):
+    """Lazy request stream of the dead-letter entries, per output path, without duplicates."""
+    configs = language_configs()
+    by_output = {}
+    for entry in entries:
+        by_output.setdefault(entry['output_path'], {})[entry['id']] = entry['article']
+    for output_path, articles in by_output.items():
+        if output_path not in configs:
+            print(f"Skipping {len(articles)} dead letters for unknown output path {output_path}")
+            continue
+        language, config, get_instructions = configs[output_path]
+        print(f"Replaying {len(articles)} {language} articles")
+        instructions = get_instructions(config)
+        prefix_name = None
+        if prefix_cache is not None:
+            prefix_name = prefix_cache.register(gemini_api.MODEL_NAME, instructions, key=language)
+        checkpoint = Checkpoint(output_path)
+        checkpoints[output_path] = checkpoint
+        requests = gemini_api.iter_documents(articles.items(), instructions, prefix_name, checkpoint, output_path)
+        if gemini_api.MAX_ARTICLE_TOKENS:
+            requests = split_long_documents(requests, gemini_api.MAX_ARTICLE_TOKENS, gemini_api.SEGMENT_OVERLAP_TOKENS)
+        yield from requests
+
+
+def replay(args):
+    entries = list(read_dead_letters(args.dead_letters))
+    if not entries:
+        print("No dead letters in", args.dead_letters)
+        return
+    replayed_path = args.dead_letters + '.replayed'
+    failed_again_path = args.dead_letters + '.new'
+    if os.path.exists(failed_again_path):
+        # Left over from an interrupted replay, whose articles are all still in the dead-letter file
+        os.remove(failed_again_path)
+
+    gemini_api.MAX_RETRIES = args.max_retries
+    gemini_api.MAX_IN_FLIGHT = args.max_in_flight
+    gemini_api.api_rate_limiter = AdaptiveRateLimiter(
+        args.requests_per_minute, args.tokens_per_minute,
+        backoff_base=args.backoff_base, backoff_cap=REPLAY_BACKOFF_CAP
+    )
+    client = gemini_api.create_client()
+    prefix_cache = create_prefix_cache(gemini_api.PREFIX_CACHE_BACKEND, client)
+    response_cache = ResponseCache(gemini_api.RESPONSE_CACHE_PATH) if gemini_api.RESPONSE_CACHE_PATH else None
+    dead_letters = DeadLetterQueue(failed_again_path)
+    metrics = RequestMetrics(gemini_api.METRICS_PATH, gemini_api.PROMETHEUS_PATH)
+    checkpoints = {}
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(gemini_api.process_grouped_documents(
+        enumerate(replay_requests(entries, prefix_cache, checkpoints)), None, client, prefix_cache,
+        checkpoints=checkpoints, response_cache=response_cache, dead_letters=dead_letters, metrics=metrics
+    ))
+    print(metrics.summary())
+    metrics.close()
+
+    print(dead_letters.summary())
+    dead_letters.close()
+    os.replace(args.dead_letters, replayed_path)
+    if os.path.exists(failed_again_path):
+        os.replace(failed_again_path, args.dead_letters)
+    print(f"Replayed {len(entries)} dead letters, {dead_letters.stats['articles']} failed again "
+          f"(replayed file kept as {replayed_path})")
+    if prefix_cache is not None:
+        print(prefix_cache.summary())
+        prefix_cache.close()
+    if response_cache is not None:
+        print(response_cache.summary())
+        response_cache.close()
+    print(gemini_api.api_rate_limiter.summary())
+    loop.run_until_complete(client.aio.aclose())
+    loop.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Re-submit the articles of failed requests")
+    parser.add_argument('--dead-letters', default=gemini_api.DEAD_LETTER_PATH)
+    parser.add_argument('--max-retries', type=int, default=REPLAY_MAX_RETRIES)
+    parser.add_argument('--max-in-flight', type=int, default=gemini_api.MAX_IN_FLIGHT)
+    parser.add_argument('--requests-per-minute', type=int, default=gemini_api.REQUESTS_PER_MINUTE)
+    parser.add_argument('--tokens-per-minute', type=int, default=gemini_api.TOKENS_PER_MINUTE)
+    parser.add_argument('--backoff-base', type=float, default=REPLAY_BACKOFF_BASE)
+    return parser
+
+
+if __name__ == '__main__':
+    replay(build_parser().parse_args())
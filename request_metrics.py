@@ -0,0 +1,185 @@
+"""
+Per-request metrics of an annotation run.
+
+process_document keeps a record of every request: how long it waited between its article being read
+and the request starting, and in the rate limiter, how long the API took, the tokens it used, its retries and how its
+annotations were aligned. RequestMetrics appends the records to a JSONL file, can keep a
+Prometheus text-format file up to date (e.g. for the node_exporter textfile collector), and
+prints a summary per corpus at the end of the run.
+"""
+import json
+import os
+import time
+
+# The Prometheus file is rewritten every this many requests, and at the end of the run
+PROMETHEUS_EVERY = 500
+
+# Timings that are summarised with percentiles
+TIMINGS = ['queue_wait', 'limiter_wait', 'api_latency', 'alignment_seconds']
+# Counters that are summed per corpus
+COUNTERS = ['articles', 'retries', 'prompt_tokens', 'cached_tokens', 'output_tokens', 'thoughts_tokens',
+            'total_tokens', 'fuzzy_matches', 'unmatched']
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def new_record(document):
+    """
+    An empty metrics record for the request of a document, filled in while it is processed.
+    The queue wait runs from the time the article was read ('read_at', see iter_documents), so it
+    covers waiting for the other articles of a packed prompt and, for the later segments of a split
+    article, for free slots in the in-flight window.
+    """
+    read_at = document.get('read_at')
+    record = {
+        'id': document['id'],
+        'source': 'api',
+        'started_at': time.time(),
+        'queue_wait': time.monotonic() - read_at if read_at is not None else 0.0,
+        'limiter_wait': 0.0,
+        'api_latency': 0.0,
+        'attempts': 0,
+        'retries': 0,
+        'errors': [],
+        'estimated_tokens': 0,
+        'prompt_tokens': 0,
+        'cached_tokens': 0,
+        'output_tokens': 0,
+        'thoughts_tokens': 0,
+        'total_tokens': 0,
+        'aligned': 0,
+        'fuzzy_matches': 0,
+        'unmatched': 0,
+        'alignment_seconds': 0.0,
+    }
+    return record
+
+
+def record_usage(record, usage_metadata):
+    """
+    Add the token counts of a response's usage metadata to a record. Thinking tokens are billed as output
+    but are not part of candidates_token_count, so they are kept separately.
+    """
+    for field, attribute in [('prompt_tokens', 'prompt_token_count'), ('cached_tokens', 'cached_content_token_count'),
+                             ('output_tokens', 'candidates_token_count'), ('thoughts_tokens', 'thoughts_token_count'),
+                             ('total_tokens', 'total_token_count')]:
+        record[field] += getattr(usage_metadata, attribute, None) or 0
+
+
+def quantile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class RequestMetrics:
+    """
+    Collects the finished request records of a run, grouped by corpus (the output path of the
+    request), and writes every record to path as one JSON line (None only keeps the summary).
+    With prometheus_path, the totals and timing quantiles are also kept in that file.
+    """
+
+    def __init__(self, path, prometheus_path=None, prometheus_every=PROMETHEUS_EVERY):
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.prometheus_every = prometheus_every
+        self.file = None
+        self.corpora = {}
+        self.records = 0
+
+    def add(self, record, output_path, articles=0, failed=False):
+        record = dict(record, output_path=output_path, articles=articles, failed=failed,
+                      finished_at=time.time())
+        if self.path is not None:
+            if self.file is None:
+                if os.path.dirname(self.path):
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+        corpus = self.corpora.setdefault(output_path, {
+            'requests': {}, 'failed': 0, 'first_started': record['started_at'], 'last_finished': 0.0,
+            **{name: [] for name in TIMINGS}, **{name: 0 for name in COUNTERS},
+        })
+        corpus['requests'][record['source']] = corpus['requests'].get(record['source'], 0) + 1
+        corpus['failed'] += failed
+        corpus['first_started'] = min(corpus['first_started'], record['started_at'])
+        corpus['last_finished'] = max(corpus['last_finished'], record['finished_at'])
+        for name in TIMINGS:
+            # Responses from the response cache and reprints never waited for the API
+            if record['source'] == 'api' or name == 'alignment_seconds':
+                corpus[name].append(record[name])
+        for name in COUNTERS:
+            corpus[name] += record[name]
+
+        self.records += 1
+        if self.prometheus_path is not None and self.records % self.prometheus_every == 0:
+            self.write_prometheus()
+
+    def write_prometheus(self):
+        """Write the totals and timing quantiles of every corpus in the Prometheus text format."""
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        corpora = {os.path.basename(path or 'output'): corpus for path, corpus in self.corpora.items()}
+        metric('annotation_requests_total', 'counter', "Finished requests by source (api, response_cache, duplicate)",
+               [({'corpus': name, 'source': source}, count)
+                for name, corpus in corpora.items() for source, count in corpus['requests'].items()])
+        metric('annotation_failed_requests_total', 'counter', "Requests that failed after their last retry",
+               [({'corpus': name}, corpus['failed']) for name, corpus in corpora.items()])
+        for counter in COUNTERS:
+            metric(f'annotation_{counter}_total', 'counter', f"Sum of {counter.replace('_', ' ')} over all requests",
+                   [({'corpus': name}, corpus[counter]) for name, corpus in corpora.items()])
+        for timing in TIMINGS:
+            name = 'annotation_' + timing.replace('_seconds', '') + '_seconds'
+            samples = []
+            for corpus_name, corpus in corpora.items():
+                samples += [({'corpus': corpus_name, 'quantile': q}, quantile(corpus[timing], q)) for q in QUANTILES]
+            lines.append(f"# HELP {name} {timing.replace('_seconds', '').replace('_', ' ')} of the requests")
+            lines.append(f"# TYPE {name} summary")
+            for labels, value in samples:
+                lines.append(f'{name}{{corpus="{labels["corpus"]}",quantile="{labels["quantile"]}"}} {value:.6f}')
+            for corpus_name, corpus in corpora.items():
+                lines.append(f'{name}_sum{{corpus="{corpus_name}"}} {sum(corpus[timing]):.6f}')
+                lines.append(f'{name}_count{{corpus="{corpus_name}"}} {len(corpus[timing])}')
+
+        if os.path.dirname(self.prometheus_path):
+            os.makedirs(os.path.dirname(self.prometheus_path), exist_ok=True)
+        with open(self.prometheus_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(self.prometheus_path + '.tmp', self.prometheus_path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.prometheus_path is not None and self.corpora:
+            self.write_prometheus()
+
+    def summary(self):
+        lines = []
+        for path, corpus in self.corpora.items():
+            elapsed = max(corpus['last_finished'] - corpus['first_started'], 1e-9)
+            articles = max(corpus['articles'], 1)
+            requests = ", ".join(f"{count} {source}" for source, count in sorted(corpus['requests'].items()))
+            lines.append(
+                f"Requests ({os.path.basename(path or 'output')}): {requests}, {corpus['failed']} failed, "
+                f"{corpus['articles']} articles in {elapsed:.1f}s ({corpus['articles'] / elapsed:.2f} articles/s)\n"
+                f"  API latency p50/p90/p99 {quantile(corpus['api_latency'], 0.5):.2f}/"
+                f"{quantile(corpus['api_latency'], 0.9):.2f}/{quantile(corpus['api_latency'], 0.99):.2f}s, "
+                f"limiter wait p50/p90 {quantile(corpus['limiter_wait'], 0.5):.2f}/"
+                f"{quantile(corpus['limiter_wait'], 0.9):.2f}s, "
+                f"queue wait p90 {quantile(corpus['queue_wait'], 0.9):.3f}s, {corpus['retries']} retries\n"
+                f"  tokens per article: {corpus['prompt_tokens'] / articles:.0f} prompt "
+                f"({corpus['cached_tokens'] / articles:.0f} cached), {corpus['output_tokens'] / articles:.0f} output "
+                f"({corpus['thoughts_tokens'] / articles:.0f} thinking); "
+                f"{corpus['fuzzy_matches']} fuzzy matches, {corpus['unmatched']} unmatched snippets, "
+                f"{sum(corpus['alignment_seconds']):.1f}s aligning"
+            )
+        return "\n".join(lines) or "Requests: none"
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+
+class ResponseCache:
+    """
+    On-disk cache of model responses, keyed on a hash of the model name and the full prompt.
+
+    Re-running the pipeline with identical prompts (e.g. after a change in the span alignment
+    or the output format) reads the responses from here instead of calling the API again.
+    Entries older than max_age_days are dropped, and once the cache holds more than
+    max_entries responses the least recently used ones are evicted.
+    """
+
+    def __init__(self, path, max_entries=200000, max_age_days=90):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_days * 24 * 3600 if max_age_days else None
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evicted': 0}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, last_used REAL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self.connection.commit()
+        self.evict()
+
+    @staticmethod
+    def key(model, prompt):
+        return hashlib.sha256((model + '\n' + prompt).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        row = self.connection.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row is None or (self.max_age_seconds and now - row[1] > self.max_age_seconds):
+            self.stats['misses'] += 1
+            return None
+        self.connection.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now, key))
+        self.connection.commit()
+        self.stats['hits'] += 1
+        return row[0]
+
+    def put(self, key, model, response):
+        now = time.time()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO responses (key, model, response, created, last_used) VALUES (?, ?, ?, ?, ?)',
+            (key, model, response, now, now)
+        )
+        self.connection.commit()
+        self.stats['writes'] += 1
+        if self.stats['writes'] % 1000 == 0:
+            self.evict()
+
+    def evict(self):
+        evicted = 0
+        if self.max_age_seconds:
+            cursor = self.connection.execute(
+                'DELETE FROM responses WHERE created < ?', (time.time() - self.max_age_seconds,)
+            )
+            evicted += cursor.rowcount
+        if self.max_entries:
+            count = self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            if count > self.max_entries:
+                cursor = self.connection.execute(
+                    'DELETE FROM responses WHERE key IN '
+                    '(SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)',
+                    (count - self.max_entries,)
+                )
+                evicted += cursor.rowcount
+        self.connection.commit()
+        self.stats['evicted'] += evicted
+
+    def close(self):
+        self.connection.close()
+
+    def summary(self):
+        return (f"Response cache: {self.stats['hits']} hits, {self.stats['misses']} misses, "
+                f"{self.stats['writes']} writes, {self.stats['evicted']} evicted")
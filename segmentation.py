@@ -0,0 +1,85 @@
+from token_utils import estimate_tokens
+
+
+def split_article(article, max_tokens, overlap_tokens=200):
+    """
+    Split an article into overlapping segments of at most max_tokens (estimated) each.
+    Returns a list of (offset, segment) pairs, where offset is the position of the segment
+    in the article. Cuts are moved back to the end of a sentence, or at least to a space,
+    when one is found in the last fifth of the segment.
+    """
+    # Characters per token of this article; Chinese has about one token per character, other text about four
+    chars_per_token = len(article) / max(estimate_tokens(article), 1)
+    max_chars = max(int(max_tokens * chars_per_token), 1)
+    overlap_chars = min(int(overlap_tokens * chars_per_token), max_chars // 2)
+    segments = []
+    start = 0
+    while start < len(article):
+        end = min(len(article), start + max_chars)
+        if end < len(article):
+            lowest = start + max_chars * 4 // 5
+            cut = max(article.rfind('. ', lowest, end), article.rfind('? ', lowest, end), article.rfind('! ', lowest, end))
+            # Chinese sentences end in a full-width mark without a following space
+            cjk_cut = max(article.rfind('。', lowest, end), article.rfind('？', lowest, end), article.rfind('！', lowest, end))
+            if cut != -1 or cjk_cut != -1:
+                end = cut + 2 if cut > cjk_cut else cjk_cut + 1
+            else:
+                cut = article.rfind(' ', lowest, end)
+                if cut != -1:
+                    end = cut + 1
+        segments.append((start, article[start:end]))
+        if end >= len(article):
+            break
+        # Start the next segment a little before the cut, on a word boundary
+        next_start = end - overlap_chars
+        space = article.find(' ', next_start, end)
+        start = space + 1 if space != -1 else next_start
+    return segments
+
+
+def split_long_documents(documents, max_tokens, overlap_tokens=200):
+    """
+    Replace every document whose article is longer than max_tokens by one document per segment.
+    Segment documents keep the fields of the original, point to it through 'parent' and record
+    their 'offset' in the original article, so their spans can be remapped once all of them are done.
+    Near-duplicates ('duplicate_of') are passed on whole, as they are not sent to the model.
+    """
+    for document in documents:
+        if 'duplicate_of' in document or estimate_tokens(document['article']) <= max_tokens:
+            yield document
+            continue
+        segments = split_article(document['article'], max_tokens, overlap_tokens)
+        parent = dict(document)
+        parent['pending_segments'] = len(segments)
+        parent['segment_annotations'] = []
+        for k, (offset, segment) in enumerate(segments):
+            segment_document = dict(document)
+            segment_document.update({
+                'id': f"{document['id']} [segment {k + 1}/{len(segments)}]",
+                'article': segment,
+                'offset': offset,
+                'parent': parent,
+            })
+            yield segment_document
+
+
+def merge_segment_annotations(annotations):
+    """
+    Sort annotations remapped to article offsets and drop the duplicates produced by the overlaps:
+    an annotation is dropped when an annotation with the same label covers at least half of it.
+    """
+    merged = []
+    for annotation in sorted(annotations, key=lambda a: (a['Span'][0], -a['Span'][1])):
+        start, end = annotation['Span']
+        duplicate = False
+        for kept in reversed(merged):
+            kept_start, kept_end = kept['Span']
+            if kept_end <= start:
+                continue
+            overlap = min(end, kept_end) - max(start, kept_start)
+            if kept['Label'] == annotation['Label'] and overlap * 2 >= max(end - start, 1):
+                duplicate = True
+                break
+        if not duplicate:
+            merged.append(annotation)
+    return merged
@@ -0,0 +1,99 @@
+from rapidfuzz import fuzz
+
+MIN_SIMILARITY_THRESHOLD = 80  # Adjusted threshold for potentially difficult matches
+
+
+class ArticleAligner:
+    """
+    Finds the spans of model-returned snippets in one article.
+
+    Alignment runs in two passes over the snippets. The exact pass looks every snippet up with
+    str.find, first after the previous exact match and then anywhere in the article, so
+    out-of-order snippets are found too; spans already handed out are skipped, so a repeated
+    snippet maps to its next occurrence. The exact matches then serve as anchors: a snippet
+    without an exact match is fuzzy-scored only against the window between the exact matches of
+    its neighbours in the response. Only when that window has no match above the threshold is
+    the rest of the article scored.
+
+    The exact pass runs snippet by snippet in add(), so it can keep up with a streamed response;
+    finish() runs the fuzzy pass once the response is complete.
+    """
+
+    def __init__(self, article_text, threshold=MIN_SIMILARITY_THRESHOLD):
+        self.article_text = article_text
+        self.threshold = threshold
+        self.used = set()
+        self.texts = []
+        self.matches = []
+        self.search_from_index = 0
+        self.stats = {'exact': 0, 'fuzzy': 0, 'missing': 0, 'full_scans': 0}
+
+    def find_exact(self, text, search_from_index=0):
+        for start, stop in ((search_from_index, len(self.article_text)), (0, search_from_index + len(text))):
+            position = self.article_text.find(text, start, stop)
+            while position != -1 and (position, position + len(text)) in self.used:
+                position = self.article_text.find(text, position + 1, stop)
+            if position != -1:
+                return position
+        return -1
+
+    def find_fuzzy(self, text, window_start, window_end):
+        """Best (start, end, score) of a fuzzy match inside the window, or None below the threshold."""
+        search_area = self.article_text[window_start:window_end]
+        if not search_area:
+            return None
+        alignment = fuzz.partial_ratio_alignment(text, search_area, score_cutoff=self.threshold)
+        if not alignment:
+            return None
+        start = window_start + alignment.dest_start
+        end = window_start + alignment.dest_end
+        if (start, end) in self.used:
+            return None
+        return start, end, alignment.score
+
+    def add(self, text):
+        """
+        Exact pass for one more snippet, as soon as it is known. Snippets without an exact
+        match are fuzzy matched in finish(), once the anchors after them are known too.
+        """
+        match = None
+        start = self.find_exact(text, self.search_from_index)
+        if start != -1:
+            match = (start, start + len(text), None)
+            self.used.add((start, start + len(text)))
+            self.search_from_index = start + len(text)
+            self.stats['exact'] += 1
+        self.texts.append(text)
+        self.matches.append(match)
+
+    def finish(self):
+        """
+        Returns one entry per snippet added: (start, end, score) with score None for an exact match,
+        or None if the snippet could not be found.
+        """
+        texts, matches = self.texts, self.matches
+        for k, text in enumerate(texts):
+            if matches[k] is not None:
+                continue
+            # Window between the closest matches before and after this snippet in the response
+            window_start = next((m[1] for m in reversed(matches[:k]) if m is not None), 0)
+            window_end = next((m[0] for m in matches[k + 1:] if m is not None), len(self.article_text))
+            match = None
+            if window_start < window_end:
+                match = self.find_fuzzy(text, window_start, window_end)
+            if match is None and (window_start, window_end) != (0, len(self.article_text)):
+                self.stats['full_scans'] += 1
+                match = self.find_fuzzy(text, 0, len(self.article_text))
+            if match is None:
+                self.stats['missing'] += 1
+                continue
+            matches[k] = match
+            self.used.add((match[0], match[1]))
+            self.stats['fuzzy'] += 1
+        return matches
+
+    def align_all(self, texts):
+        """Aligns a complete list of snippets, see finish() for the entries returned."""
+        for text in texts:
+            self.add(text)
+        return self.finish()
@@ -0,0 +1,92 @@
+"""
+Startup-time benchmark of the scripts, to guard against heavy imports creeping back in.
+
+Every module is imported in a fresh interpreter a few times. The benchmark fails (exit code 1)
+when the median import time is over the module's budget, or when the import loads one of the
+heavy dependencies that module is only supposed to load on first use.
+
+    python startup_benchmark.py --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ['pandas', 'matplotlib', 'google.genai', 'httpx', 'rapidfuzz', 'docx', 'numpy']
+
+# Module -> (import time budget in seconds, heavy modules it may load when imported)
+IMPORT_BUDGETS = {
+    'cli': (0.1, []),
+    'convert_to_json': (0.1, []),
+    'analyse_annotations': (0.3, ['numpy']),
+    'gemini_api': (0.3, ['rapidfuzz']),
+    'gemini_api_de': (0.3, ['rapidfuzz']),
+    'gemini_api_all': (0.3, ['rapidfuzz']),
+    'replay': (0.3, ['rapidfuzz']),
+}
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [name for name in {heavy!r} if name in sys.modules]]))
+"""
+
+
+def measure_import(module, repeat):
+    """Median import time of module over repeat fresh interpreters, and the heavy modules it loaded."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=directory, capture_output=True, text=True, check=True
+        ).stdout
+        elapsed, loaded = json.loads(output.splitlines()[-1])
+        times.append(elapsed)
+    return statistics.median(times), loaded
+
+
+def measure_command(argv, repeat):
+    """Median wall time of running a command in a fresh interpreter, including interpreter startup."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + argv, cwd=directory, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def run(args):
+    failures = []
+    print(f"{'module':<22}{'import (s)':>12}{'budget (s)':>12}  heavy modules loaded")
+    for module, (budget, allowed) in IMPORT_BUDGETS.items():
+        elapsed, loaded = measure_import(module, args.repeat)
+        unexpected = [name for name in loaded if name not in allowed]
+        print(f"{module:<22}{elapsed:>12.3f}{budget * args.budget_factor:>12.3f}  {', '.join(loaded) or '-'}")
+        if elapsed > budget * args.budget_factor:
+            failures.append(f"{module} took {elapsed:.3f}s to import (budget {budget * args.budget_factor:.3f}s)")
+        if unexpected:
+            failures.append(f"{module} imports {', '.join(unexpected)} at import time")
+    print(f"python cli.py --help: {measure_command(['cli.py', '--help'], args.repeat):.3f}s")
+
+    for failure in failures:
+        print("FAIL:", failure)
+    return 1 if failures else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Startup-time benchmark of the scripts")
+    parser.add_argument('--repeat', type=int, default=5, help="Fresh interpreters per measurement")
+    parser.add_argument('--budget-factor', type=float, default=1.0, help="Scale all budgets, e.g. for slow machines")
+    return parser
+
+
+if __name__ == '__main__':
+    sys.exit(run(build_parser().parse_args()))
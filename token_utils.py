@@ -0,0 +1,20 @@
+import re
+
+CHARS_PER_TOKEN = 4
+
+# Chinese and Japanese characters and their punctuation, which come to about one token each
+CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    """
+    Rough token count for a piece of text, used wherever we need to budget prompts
+    without calling the tokenizer endpoint. Gemini averages about four characters per token,
+    but about one token per character of Chinese.
+    """
+    if not text:
+        return 0
+    if text.isascii():
+        return len(text) // CHARS_PER_TOKEN + 1
+    cjk_chars = len(CJK_PATTERN.findall(text))
+    return cjk_chars + (len(text) - cjk_chars) // CHARS_PER_TOKEN + 1
@@ -0,0 +1,172 @@
+"""
+Local relevance triage of the articles before they are sent to the model.
+
+The corpora are keyword search results, and many hits are ads, price lists, image captions or
+fragments of a few words. Every article is scored on its length, the share of digits in it and
+how often it mentions children (the keyword lists below); articles that fail a rule are skipped
+instead of paying for a request. Every decision is appended to a JSONL log. Short articles that
+pass are still annotated, and are packed with others where BATCH_TOKEN_BUDGET is set.
+
+The effect of the rules on the labels can be checked against a corpus that was already annotated:
+
+    python triage.py results/articles_de_corpus_annotated.jsonl --language german
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+from token_utils import estimate_tokens
+
+# Articles shorter than this many tokens are skipped
+TRIAGE_MIN_TOKENS = 8
+
+# Articles in which more than this share of the letters and digits are digits (price lists, tables) are skipped
+TRIAGE_MAX_DIGIT_SHARE = 0.3
+
+# Articles with fewer mentions of children than this per 1000 tokens are skipped (0 keeps every article
+# that mentions children at all)
+TRIAGE_MIN_KEYWORD_DENSITY = 0
+
+TRIAGE_LOG_PATH = "results/triage_decisions.jsonl"
+
+# Words that refer to children (and child workers) in each corpus; an article that mentions none of
+# them is not about child labor
+TRIAGE_KEYWORDS = {
+    "english": r"child|juvenile|\bminors?\b|\bboys?\b|\bgirls?\b|\byouths?\b|infant|apprentic|\bkids?\b|\blads?\b",
+    "french": r"enfan|\bmineurs?\b|garçon|fillette|\bjeunes?\b|apprenti|adolescen|\bgamins?\b|écoli",
+    "german": r"kind|jugend|knabe|mädchen|lehrling|minderjährig|schulpflicht|\bbuben?\b",
+    "chinese": r"童|孩|幼|少年|學徒|学徒|小工|女工",
+}
+
+DIGIT_PATTERN = re.compile(r'\d')
+ALNUM_PATTERN = re.compile(r'\w')
+
+
+def triage_features(article, keywords):
+    tokens = estimate_tokens(article)
+    alnum = len(ALNUM_PATTERN.findall(article))
+    keyword_hits = len(keywords.findall(article))
+    return {
+        'tokens': tokens,
+        'digit_share': round(len(DIGIT_PATTERN.findall(article)) / alnum, 3) if alnum else 0.0,
+        'keyword_hits': keyword_hits,
+        'keyword_density': round(keyword_hits * 1000 / tokens, 1) if tokens else 0.0,
+    }
+
+
+def triage_decision(features):
+    """The reason to skip an article with these features, or None to annotate it."""
+    if features['tokens'] < TRIAGE_MIN_TOKENS:
+        return 'too short'
+    if features['digit_share'] > TRIAGE_MAX_DIGIT_SHARE:
+        return 'mostly digits'
+    if features['keyword_hits'] == 0:
+        return 'no keyword'
+    if features['keyword_density'] < TRIAGE_MIN_KEYWORD_DENSITY:
+        return 'low keyword density'
+    return None
+
+
+class Triage:
+    """
+    Scores the articles of one language and logs every decision to log_path (None only counts them).
+    The log file is shared by all languages of a run, as every line holds the language.
+    """
+
+    def __init__(self, language, log_path=TRIAGE_LOG_PATH):
+        self.language = language
+        self.keywords = re.compile(TRIAGE_KEYWORDS[language], re.IGNORECASE)
+        self.log_path = log_path
+        self.file = None
+        self.stats = {'kept': 0, 'skipped': 0, 'skipped_tokens': 0}
+        self.reasons = {}
+
+    def keep(self, id, article):
+        features = triage_features(article, self.keywords)
+        reason = triage_decision(features)
+        if reason is None:
+            self.stats['kept'] += 1
+        else:
+            self.stats['skipped'] += 1
+            self.stats['skipped_tokens'] += features['tokens']
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        if self.log_path is not None:
+            if self.file is None:
+                if os.path.dirname(self.log_path):
+                    os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+                self.file = open(self.log_path, 'a', encoding='utf-8')
+            entry = dict(id=id, language=self.language, decision='annotate' if reason is None else 'skip',
+                         reason=reason, decided_at=time.strftime('%Y-%m-%dT%H:%M:%S'), **features)
+            self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        return reason is None
+
+    def filter(self, documents):
+        """The request documents that pass triage; skipped articles are not written and not checkpointed."""
+        for document in documents:
+            if self.keep(document['id'], document['article']):
+                yield document
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def summary(self):
+        total = self.stats['kept'] + self.stats['skipped']
+        if not total:
+            return f"Triage ({self.language}): no articles"
+        reasons = ", ".join(f"{count} {reason}" for reason, count in sorted(self.reasons.items())) or "none"
+        return (f"Triage ({self.language}): skipped {self.stats['skipped']} of {total} articles "
+                f"({self.stats['skipped'] / total:.1%}, about {self.stats['skipped_tokens']} article tokens); "
+                f"reasons: {reasons}")
+
+
+def evaluate(path, language):
+    """
+    Triage the articles of an annotated JSONL and count the labels that would have been lost,
+    i.e. the labels of the articles the rules would skip. Returns (triage, labels, lost labels).
+    """
+    triage = Triage(language, log_path=None)
+    labels = {}
+    lost = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            annotations = record.get('annotations') or []
+            # Older files store the annotations as a JSON string instead of a list
+            if isinstance(annotations, str):
+                annotations = json.loads(annotations)
+            kept = triage.keep(record['id'], record['article'])
+            for annotation in annotations:
+                for label in annotation['Label'].split(';'):
+                    label = label.strip()
+                    labels[label] = labels.get(label, 0) + 1
+                    if not kept:
+                        lost[label] = lost.get(label, 0) + 1
+    return triage, labels, lost
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Check the triage rules against an annotated corpus")
+    parser.add_argument('annotated', help="Annotated JSONL of one language")
+    parser.add_argument('--language', required=True, choices=list(TRIAGE_KEYWORDS))
+    return parser
+
+
+def run(args):
+    triage, labels, lost = evaluate(args.annotated, args.language)
+    print(triage.summary())
+    print(f"{'label':<40}{'labels':>10}{'lost':>10}{'lost (%)':>10}")
+    for label, count in sorted(labels.items(), key=lambda item: -item[1]):
+        print(f"{label:<40}{count:>10}{lost.get(label, 0):>10}{lost.get(label, 0) / count:>10.1%}")
+    total = sum(labels.values())
+    if total:
+        print(f"{'all labels':<40}{total:>10}{sum(lost.values()):>10}{sum(lost.values()) / total:>10.1%}")
+
+
+if __name__ == '__main__':
+    run(build_parser().parse_args())